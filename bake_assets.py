@@ -0,0 +1,141 @@
+"""
+Bake all pictures of the Images folder into one pack file. The game loads the pack through a
+memory map instead of decoding PNG and GIF-files. Bake the pack again after changing pictures
+(the game does not use the baked pictures of changed files). The levels are baked too: the
+levels folder -> levels.pack with the parsed level maps.
+
+    python bake_assets.py                     # Images -> Images.pack, levels -> levels.pack
+    python bake_assets.py --output other.pack
+
+Pack: header (magic, version, size of the index), JSON index, pixels. Every entry of the index
+has the offset and the size of its pixels; GIF-frames of one file are one vertical strip with
+the rect and duration of every frame.
+"""
+import argparse
+import json
+import os
+
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+import pygame
+from PIL import Image
+
+import game_in_general as game
+
+
+def pixel_format():
+    """
+    Order of the bytes in the pack: the order of the display format, if pygame can use it
+    :return: 'BGRA' or 'RGBA'
+    """
+    try:
+        pygame.image.frombuffer(bytes(4), (1, 1), 'BGRA')
+    except ValueError:
+        return 'RGBA'
+    return 'BGRA'
+
+
+def source(path):
+    """
+    Size and modification time of the file (the game compares them with the file)
+    :param path: path to the file
+    :return: dict
+    """
+    stat = os.stat(path)
+    return {'bytes': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def bake(folder='Images'):
+    """
+    Decode all pictures of the folder
+    :param folder: folder with pictures
+    :return: index and list of pixel blocks
+    """
+    fmt = pixel_format()
+    index = {'format': fmt, 'images': {}, 'animations': {}}
+    blocks, offset = [], 0
+    for directory, _, files in sorted(os.walk(folder)):
+        for filename in sorted(files):
+            path = os.path.join(directory, filename)
+            name = path.replace(os.sep, '/')
+            if filename.endswith('.png'):
+                surface = pygame.image.load(path)
+                pixels = pygame.image.tostring(surface, fmt)
+                entry = {'offset': offset, 'size': list(surface.get_size())}
+                index['images'][name] = entry
+            elif filename.endswith('.gif'):
+                try:
+                    frames = game.decode_gif(Image.open(path))
+                except Exception as error:
+                    print('Skip', name, '-', str(error).strip())
+                    continue
+                width, height = frames[0][0].get_size()
+                pixels = b''.join(pygame.image.tostring(frame, fmt) for frame, _ in frames)
+                entry = {'offset': offset, 'size': [width, height * len(frames)],
+                         'frames': [[0, height * i, width, height, duration]
+                                    for i, (_, duration) in enumerate(frames)]}
+                index['animations'][name] = entry
+            else:
+                continue
+            entry.update(source(path))
+            blocks.append(pixels)
+            offset += len(pixels)
+    return index, blocks
+
+
+def bake_levels(folder=game.LEVELS_FOLDER):
+    """
+    Parse all level files of the folder
+    :param folder: folder with the level files
+    :return: pack of the levels
+    """
+    levels = {}
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith('.txt'):
+            template = game.LevelTemplate.load(filename[:-4], folder)
+            levels[template.name] = {'exits': list(template.exits), 'rows': list(template.rows)}
+            levels[template.name].update(source(os.path.join(folder, filename)))
+    return {'version': game.LEVEL_PACK_VERSION, 'levels': levels}
+
+
+def write(filename, index, blocks):
+    """
+    Write the pack file
+    :param filename: name of the pack file
+    :param index: index of the pack
+    :param blocks: pixels of the entries
+    :return: size of the file
+    """
+    index_bytes = json.dumps(index, sort_keys=True).encode()
+    data_offset = game.asset_pack_data_offset(len(index_bytes))
+    with open(filename, 'wb') as pack_file:
+        pack_file.write(game.ASSET_PACK_HEADER.pack(game.ASSET_PACK_MAGIC, game.ASSET_PACK_VERSION,
+                                                    len(index_bytes)))
+        pack_file.write(index_bytes)
+        pack_file.write(bytes(data_offset - pack_file.tell()))
+        for pixels in blocks:
+            pack_file.write(pixels)
+        return pack_file.tell()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bake the pictures into one pack file')
+    parser.add_argument('--output', default=game.ASSET_PACK, help='pack file')
+    parser.add_argument('--images', default='Images', help='folder with pictures')
+    parser.add_argument('--levels-output', default=game.LEVEL_PACK, help='level pack file')
+    parser.add_argument('--levels', default=game.LEVELS_FOLDER, help='folder with levels')
+    args = parser.parse_args()
+
+    pygame.init()
+    # frames are decoded in the display format, like in the game
+    pygame.display.set_mode((1, 1))
+    index, blocks = bake(args.images)
+    size = write(args.output, index, blocks)
+    print('{}: {} pictures, {} animations, {:.1f} MB'.format(
+        args.output, len(index['images']), len(index['animations']), size / 2 ** 20))
+    levels = bake_levels(args.levels)
+    with open(args.levels_output, 'w') as levels_file:
+        json.dump(levels, levels_file, sort_keys=True)
+    print('{}: {} levels'.format(args.levels_output, len(levels['levels'])))
+    pygame.quit()
@@ -0,0 +1,583 @@
+"""
+Benchmarks of the hot functions of the game.
+
+    python benchmark.py                               # run and save results to benchmark.json
+    python benchmark.py --compare baseline.json       # run and compare with saved results
+    python benchmark.py --soak                        # only the scene soak (fails on growth)
+    python benchmark.py --replay                      # only the check of the seeded replays
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+import pygame
+from PIL import Image
+
+import game_in_general as game
+
+
+def measure(func, number=1, repeat=5):
+    """
+    Measure the time of the function
+    :param func: function without arguments
+    :param number: how many times function is called in one measurement
+    :param repeat: how many measurements are done (the best one is taken)
+    :return: seconds per one call
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        result = (time.perf_counter() - start) / number
+        if best is None or result < best:
+            best = result
+    return best
+
+
+def level_names():
+    """
+    Names of all levels in the levels folder
+    :return: list of names without extension
+    """
+    return sorted(name[:-4] for name in os.listdir('levels') if name.endswith('.txt'))
+
+
+def create_main(seed=0):
+    """
+    Create the game in headless mode with the new game started
+    :param seed: seed of the map generation
+    :return: Main
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        main = game.Main(headless=True, seed=seed)
+        main.new_game()
+    main.player_parameters[5] = 10 ** 9
+    return main
+
+
+def enter_room(main, name):
+    """
+    Put the room in the current map position and load it
+    :param main: game
+    :param name: name of the level
+    :return: Room
+    """
+    game_map = main.game_map
+    room = game.Room(name, main)
+    game_map.map[game_map.current_y][game_map.current_x] = room
+    main.load_room(room.exits[0])
+    main.player.player_parameters[5] = 10 ** 9
+    return main.room
+
+
+def free_cells(room):
+    """
+    Cells of the room where enemies can walk
+    :param room: Room
+    :return: list of coords
+    """
+    height = len(room.block_player_grid)
+    return [(x, y) for y in range(height) for x in range(len(room.room_map[y]))
+            if room.room_map[y][x] != 0]
+
+
+def bench_find_way(main):
+    """
+    Room.find_way between all pairs of walkable cells of every level
+    :return: dict metric: microseconds per call
+    """
+    results = {}
+    for name in level_names():
+        room = enter_room(main, name)
+        cells = free_cells(room)
+
+        def find_all():
+            room.invalidate_flow_field()
+            for target in cells:
+                for start in cells:
+                    room.find_way(start, target)
+
+        results['find_way/' + name] = measure(find_all, repeat=1) / len(cells) ** 2 * 1e6
+    return results
+
+
+def bench_decode_gif():
+    """
+    Decoding of every GIF-file in the Images folder (without cache). Files which can not be
+    decoded are skipped
+    :return: dict metric: milliseconds per file
+    """
+    results = {}
+    for folder, _, files in os.walk('Images'):
+        for filename in sorted(files):
+            if filename.endswith('.gif'):
+                path = os.path.join(folder, filename)
+                try:
+                    game.decode_gif(Image.open(path))
+                except Exception as error:
+                    print('Skip', path, '-', str(error).strip())
+                    continue
+                results['decode_gif/' + path.replace(os.sep, '/')] = measure(
+                    lambda: game.decode_gif(Image.open(path))) * 1e3
+    return results
+
+
+def bench_generate_map(main, rooms_counts=(2, 3, 4, 5)):
+    """
+    Map generation with different rooms count
+    :return: dict metric: milliseconds per map
+    """
+    results = {}
+    for rooms_count in rooms_counts:
+        with contextlib.redirect_stdout(io.StringIO()):
+            results['generate_map/%d' % rooms_count] = measure(
+                lambda: game.Map(rooms_count, main), number=5) * 1e3
+    return results
+
+
+def bench_movement(main, names=('boss_room', 'mexico', 'circle', 'start')):
+    """
+    Collision checks of Player.move and Enemy.move
+    :return: dict metric: microseconds per call
+    """
+    results = {}
+    for name in names:
+        room = enter_room(main, name)
+        start = main.player.rect.topleft
+        main.register_bodies()
+
+        def move_player():
+            main.player.rect.topleft = start
+            main.bodies.update(main.player)
+            for direction in (0, 1, 2, 3):
+                main.player.move(direction)
+
+        results['player_move/' + name] = measure(move_player, number=500) / 4 * 1e6
+        enemies = list(main.enemy_group)
+        if enemies:
+            positions = [enemy.rect.topleft for enemy in enemies]
+
+            def move_enemies():
+                for enemy, position in zip(enemies, positions):
+                    enemy.rect.topleft = position
+                    main.bodies.update(enemy)
+                for enemy in enemies:
+                    enemy.step = room.next_step(enemy.get_pos(*enemy.rect.topleft),
+                                                enemy.get_pos(*main.player.rect.topleft))
+                    enemy.move()
+
+            results['enemy_move/' + name] = measure(move_enemies, number=500) / len(
+                enemies) * 1e6
+    return results
+
+
+def crowd_room(main, enemies_count):
+    """
+    Enter the start room and spawn enemies in its free cells (not near the player)
+    :param enemies_count: how many enemies are spawned
+    :return: free cells of the room
+    """
+    room = enter_room(main, 'start')
+    cells = [cell for cell in free_cells(room) if abs(cell[0] - 8) + abs(cell[1] - 6) > 2]
+    for x, y in cells[:enemies_count]:
+        game.Enemy(room, x, y, main.assets.get('Cop'), main.assets.get('Cop_shoot'), -1, main)
+        room.enemies += 1
+    main.game_map.update_doors()
+    return cells
+
+
+def bench_frame(main, enemies_counts=(0, 4, 16), bullets_counts=(0, 20, 100, 400), frames=100):
+    """
+    Full simulated frame (Main.step) with N enemies and M bullets in the start room
+    :return: dict metric: milliseconds per frame
+    """
+    results = {}
+    for enemies_count in enemies_counts:
+        for bullets_count in bullets_counts:
+            cells = crowd_room(main, enemies_count)
+            total = 0
+            with contextlib.redirect_stdout(io.StringIO()):
+                for frame in range(frames):
+                    while len(main.bullets) < bullets_count:
+                        x, y = cells[(frame + len(main.bullets)) % len(cells)]
+                        main.bullets.spawn(x * 50 + 20, y * 50 + 20, main.assets.get('tear'),
+                                           len(main.bullets) % 4, 5, main.player_group)
+                    start = time.perf_counter()
+                    main.step()
+                    total += time.perf_counter() - start
+            results['frame/%d_enemies_%d_bullets' % (enemies_count, bullets_count)] = \
+                total / frames * 1e3
+    return results
+
+
+def bench_ai(main, enemies_counts=(48, 96, 144), frames=150):
+    """
+    Frames of the stress rooms with the AI budget, with a quarter of it (the budget is spent
+    there before all enemies think) and without it (every enemy thinks in every frame).
+    The frames and the decisions are counted in the processor time of the thread
+    (the budget too), so the pauses of other processes don't make the worst frames
+    :return: dict metric: milliseconds per frame and decisions per frame (mean, 95th
+             percentile and the worst frame)
+    """
+    results = {}
+    budget, clock, decision_cost = main.ai.budget, main.ai.clock, main.ai.decision_cost
+    main.ai.clock, main.ai.decision_cost = time.thread_time, None
+    for name, main.ai.budget in (('budget', budget), ('budget_quarter', budget / 4),
+                                 ('unlimited', float('inf'))):
+        for enemies_count in enemies_counts:
+            crowd_room(main, enemies_count)
+            times, decisions = [], []
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(frames):
+                    start = time.thread_time()
+                    main.step()
+                    times.append(time.thread_time() - start)
+                    decisions.append(main.ai.spent)
+            prefix = 'ai/%s_%d_enemies' % (name, enemies_count)
+            for metric, values in (('', times), ('_decide', decisions)):
+                values.sort()
+                results[prefix + metric + '_mean'] = sum(values) / frames * 1e3
+                results[prefix + metric + '_p95'] = values[frames * 95 // 100] * 1e3
+                results[prefix + metric + '_max'] = values[-1] * 1e3
+    main.ai.budget, main.ai.clock, main.ai.decision_cost = budget, clock, decision_cost
+    return results
+
+
+def bench_rooms(main, visits=50):
+    """
+    Door transitions: the first visit of the room (it is built on the transition), the first
+    visit of the room planned by the prefetch thread (its background is drawn on the
+    transition), the first visit of the room planned and drawn after the frames and the next
+    visits (only the player is placed)
+    :return: dict metric: milliseconds per transition
+    """
+    game_map = main.game_map
+    cells = [(x, y) for y, row in enumerate(game_map.map) for x, room in enumerate(row) if room]
+    cells = cells[:game.ROOMS_RESIDENT]
+    results = {}
+    for name, count in (('first_visit', 1), ('planned', 1), ('prefetched', 1),
+                        ('revisit', visits)):
+        total = 0
+        for _ in range(count):
+            for x, y in cells:
+                room = game_map.map[y][x]
+                if count == 1:
+                    room.unload()
+                    main.prefetcher.request([] if name == 'first_visit' else [room])
+                    main.prefetcher.wait()
+                    while name == 'prefetched' and main.prefetcher.idle():
+                        pass
+                game_map.current_x, game_map.current_y = x, y
+                start = time.perf_counter()
+                main.load_room(min(room.template.doors, default=0))
+                total += time.perf_counter() - start
+        results['rooms/' + name] = total / count / len(cells) * 1e3
+    return results
+
+
+# started in a new process: time to the first frame and peak resident memory
+STARTUP_CODE = """
+import os
+import time
+start = time.perf_counter()
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+import game_in_general as game
+game.pygame.init()
+main = game.Main(headless=True, seed=0)
+main.new_game()
+main.step()
+seconds = time.perf_counter() - start
+try:
+    import resource
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+except ImportError:
+    memory = 0
+print(seconds, memory)
+"""
+
+
+def bench_startup(repeat=3):
+    """
+    Time from the start of the game to the first frame and peak resident memory, with loose
+    picture files and with the asset pack (when it is baked)
+    :return: dict metric: milliseconds or megabytes
+    """
+    results = {}
+    sources = [('loose', '')]
+    if os.path.exists(game.ASSET_PACK):
+        sources.append(('pack', game.ASSET_PACK))
+    for name, pack in sources:
+        env = dict(os.environ, PUNKS_ASSET_PACK=pack)
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', STARTUP_CODE], env=env,
+                                    stdout=subprocess.PIPE, universal_newlines=True,
+                                    check=True).stdout
+            runs.append(tuple(map(float, output.split()[-2:])))
+        results['startup/%s_first_frame' % name] = min(run[0] for run in runs) * 1e3
+        if runs[0][1]:
+            results['startup/%s_memory_mb' % name] = min(run[1] for run in runs)
+    return results
+
+
+# limits of the scene soak (check_scenes): the deepest stack of scenes (game, pause, settings)
+# and how much more memory the last game may hold after the last quarter of the cycles than
+# after the third one (one leaked game per cycle is a few megabytes)
+SOAK_SCENES_MAX = 3
+SOAK_MEMORY_GROWTH_KB = 256
+
+
+def stack_depth():
+    """
+    Depth of the Python call stack
+    :return: count of frames
+    """
+    depth, frame = 0, sys._getframe()
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+def bench_scenes(main, cycles=200):
+    """
+    Restarts and menu round-trips through the stack of scenes (pause, settings, authors, R,
+    game over and victory). Memory is traced in the second half of the cycles: only the last
+    game stays alive, so the memory held after the third quarter and after the last quarter
+    must be the same (check_scenes)
+    :return: dict metric: value
+    """
+    depths, memory = [], []
+    step = main.step
+
+    def measured_step():
+        depths.append(stack_depth())
+        return step()
+
+    def play(frames, keys=()):
+        main.input = game.ScriptedInput([(frames, keys)])
+        for _ in range(frames):
+            transition = main.scenes[-1].update()
+            if transition is not None:
+                main.change_scene(transition)
+
+    main.step = measured_step
+    scenes_max = 0
+    # the output is not kept, else it grows with the count of cycles
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for cycle in range(cycles):
+            if cycle == cycles // 2:
+                gc.collect()
+                tracemalloc.start()
+            elif cycle == cycles * 3 // 4:
+                gc.collect()
+                memory.append(tracemalloc.get_traced_memory()[0])
+            main.change_scene(main.start_game())
+            play(5)
+            main.change_scene(main.pause())
+            main.change_scene(main.settings())
+            for _ in main.diff_stages:
+                main.change_settings_difficult()
+            scenes_max = max(scenes_max, len(main.scenes))
+            main.change_scene(main.stop())
+            main.change_scene(main.stop())
+            play(3, ['r'])
+            main.game_over()
+            play(1)
+            main.change_scene(main.autors_show())
+            main.change_scene(main.stop())
+            main.change_scene(main.start_game())
+            main.congratulations()
+            play(1)
+        gc.collect()
+        memory.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+    main.step = step
+    main.input = game.ScriptedInput()
+    main.change_scene(main.start_game())
+    return {'scenes/stack_depth': max(depths),
+            'scenes/stack_depth_growth': depths[-1] - depths[0],
+            'scenes/scenes_max': scenes_max,
+            'scenes/memory_kb': memory[-1] / 1024,
+            'scenes/memory_growth_kb': (memory[-1] - memory[0]) / 1024}
+
+
+def check_scenes(metrics):
+    """
+    Check that the scene soak does not grow: the call stack, the stack of scenes and the memory
+    :param metrics: results of bench_scenes
+    :return: list of failed checks
+    """
+    failures = []
+    if metrics['scenes/stack_depth_growth'] != 0:
+        failures.append('call stack grows by {} frames'.format(
+            metrics['scenes/stack_depth_growth']))
+    if metrics['scenes/scenes_max'] > SOAK_SCENES_MAX:
+        failures.append('{} scenes on the stack (limit {})'.format(
+            metrics['scenes/scenes_max'], SOAK_SCENES_MAX))
+    if metrics['scenes/memory_growth_kb'] > SOAK_MEMORY_GROWTH_KB:
+        failures.append('memory grows by {:.1f} KB (limit {} KB)'.format(
+            metrics['scenes/memory_growth_kb'], SOAK_MEMORY_GROWTH_KB))
+    return failures
+
+
+# the replay check: keys of the input script (frames count, keys) and slowdown of the clock
+# of the AI in the second run (a slower computer)
+REPLAY_SCRIPT = [(40, ['d', 'UP']), (30, ['s', 'LEFT']), (60, ['a']), (40, ['w', 'RIGHT']),
+                 (30, ['d', 'DOWN'])]
+REPLAY_SLOWDOWN = 100
+
+
+def game_state(main):
+    """
+    State of the game which must be the same in the replays
+    :return: tuple with the room, the player, the enemies and the bullets
+    """
+    main.bullets.flush()
+    return (main.room.filename, tuple(main.player.rect), main.player_parameters[5],
+            [(tuple(enemy.rect), enemy.hp) for enemy in main.enemy_group],
+            sorted(zip(main.bullets.x.tolist(), main.bullets.y.tolist())))
+
+
+def check_replay(seed=0, enemies_count=144, frames=400):
+    """
+    Two seeded headless runs with the same input must end in the same state. The AI budget is
+    a quarter of the usual one, so not every enemy thinks in every frame, and the second run
+    counts the time of the decisions on a slower clock
+    :return: list of failed checks
+    """
+    states = []
+    for slowdown in (1, REPLAY_SLOWDOWN):
+        main = create_main(seed)
+        main.ai.budget /= 4
+        main.ai.clock = lambda: time.perf_counter() * slowdown
+        crowd_room(main, enemies_count)
+        main.input = game.ScriptedInput(REPLAY_SCRIPT * (frames // 200 + 1))
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for _ in range(frames):
+                main.step()
+        states.append((game_state(main), main.ai.stats()))
+    failures = []
+    if states[0][0] != states[1][0]:
+        failures.append('seeded headless runs end in different states (AI {} and {})'.format(
+            states[0][1], states[1][1]))
+    return failures
+
+
+def run(quick=False):
+    """
+    Run all benchmarks
+    :param quick: skip the slowest benchmarks
+    :return: dict with results
+    """
+    pygame.init()
+    main = create_main()
+    metrics = {}
+    if not quick:
+        metrics.update(bench_find_way(main))
+    metrics.update(bench_decode_gif())
+    metrics.update(bench_generate_map(main))
+    metrics.update(bench_movement(main))
+    metrics.update(bench_rooms(create_main(3)))
+    metrics.update(bench_frame(main))
+    metrics.update(bench_ai(main))
+    metrics.update(bench_scenes(main, 40 if quick else 200))
+    metrics.update(bench_startup())
+    pygame.quit()
+    return {'python': sys.version.split()[0], 'pygame': pygame.version.ver,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'metrics': metrics}
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the comparison of the results with the baseline
+    :param results: new results
+    :param baseline: saved results
+    :param threshold: which slowdown is regression (0.1 - 10 %)
+    :return: list of regressed metrics
+    """
+    regressions = []
+    for name, value in results['metrics'].items():
+        old = baseline['metrics'].get(name)
+        if not old:
+            print('{:<60} {:>12.4f}   (new)'.format(name, value))
+            continue
+        change = value / old - 1
+        mark = ''
+        if change > threshold:
+            mark = 'SLOWER'
+            regressions.append(name)
+        elif change < -threshold:
+            mark = 'faster'
+        print('{:<60} {:>12.4f} {:>12.4f} {:>+8.1%} {}'.format(name, old, value, change, mark))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the game')
+    parser.add_argument('--output', default='benchmark.json', help='file for the results')
+    parser.add_argument('--compare', default=None, help='file with the baseline results')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown which is a regression (0.1 - 10 %%)')
+    parser.add_argument('--quick', action='store_true', help='skip find_way between all cells')
+    parser.add_argument('--soak', action='store_true',
+                        help='run only the scene soak and its checks')
+    parser.add_argument('--replay', action='store_true',
+                        help='run only the check of the seeded headless replays')
+    args = parser.parse_args()
+
+    if args.replay:
+        pygame.init()
+        failures = check_replay()
+        pygame.quit()
+        if failures:
+            print('Replay failed:', '; '.join(failures))
+            sys.exit(1)
+        print('Replay: the same state')
+        sys.exit(0)
+
+    if args.soak:
+        pygame.init()
+        metrics = bench_scenes(create_main())
+        pygame.quit()
+        for name, value in metrics.items():
+            print('{:<60} {:>12.4f}'.format(name, value))
+        failures = check_scenes(metrics)
+        if failures:
+            print('Scene soak failed:', '; '.join(failures))
+            sys.exit(1)
+        sys.exit(0)
+
+    results = run(args.quick)
+    failures = check_scenes(results['metrics'])
+    pygame.init()
+    failures += check_replay()
+    pygame.quit()
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('Slower than baseline:', ', '.join(regressions))
+    else:
+        regressions = []
+        for name, value in results['metrics'].items():
+            print('{:<60} {:>12.4f}'.format(name, value))
+    if failures:
+        print('Checks failed:', '; '.join(failures))
+    if regressions or failures:
+        sys.exit(1)
@@ -1,38 +1,241 @@
+import argparse
+import cProfile
+import csv
+import json
+import mmap
 import os
+import queue
+import struct
 import sys
+import threading
 import time
-from random import choice
+from collections import OrderedDict, deque
+from random import Random, choice
 
+import numpy as np
 import pygame
-from PIL import Image
 from pygame.locals import *
 
 
-def load_image(name, colorkey=None):
+# file with the baked pictures (made by bake_assets.py), PUNKS_ASSET_PACK can change it
+ASSET_PACK = os.environ.get('PUNKS_ASSET_PACK', 'Images.pack')
+ASSET_PACK_MAGIC = b'PUNKPACK'
+ASSET_PACK_VERSION = 1
+# header of the pack: magic, version and size of the JSON index
+ASSET_PACK_HEADER = struct.Struct('<8sII')
+
+
+def asset_pack_data_offset(index_size):
     """
-    Function for loading pictures from Images folders
+    Position of the pixels in the pack file (after the header and the index, aligned to 16 bytes)
+    :param index_size: size of the JSON index in bytes
+    :return: offset in bytes
+    """
+    return (ASSET_PACK_HEADER.size + index_size + 15) // 16 * 16
+
+
+class AssetPack:
+    def __init__(self, filename=ASSET_PACK):
+        """
+        initialization of class AssetPack. The pack holds decoded pixels of all pictures and
+        GIF-frames (GIF-frames of one file are one vertical strip). The pack is opened through a
+        memory map on the first use and surfaces are made over its buffer without copying.
+        When there is no pack the pictures are loaded from their files
+        :param filename: name of the pack file
+        """
+        self.filename = filename
+        self.index, self.pixels = None, None
+        self.native = None
+
+    def open(self):
+        """
+        Open the pack and read its index. A missing or broken pack is not used
+        :return: None
+        """
+        self.index = {'images': {}, 'animations': {}}
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'rb') as pack_file:
+                buffer = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_COPY)
+            magic, version, index_size = ASSET_PACK_HEADER.unpack_from(buffer)
+            if magic != ASSET_PACK_MAGIC or version != ASSET_PACK_VERSION:
+                raise ValueError('неизвестная версия')
+            index = json.loads(buffer[ASSET_PACK_HEADER.size:ASSET_PACK_HEADER.size + index_size])
+            pygame.image.frombuffer(bytes(4), (1, 1), index['format'])
+        except (OSError, ValueError, KeyError, TypeError, struct.error, pygame.error) as error:
+            print('Не могу открыть', self.filename, '-', error)
+            return
+        self.pixels = memoryview(buffer)[asset_pack_data_offset(index_size):]
+        self.index = index
+
+    def find(self, kind, filename):
+        """
+        Find the entry of the file. Entries of changed files are not used
+        :param kind: 'images' or 'animations'
+        :param filename: path to the file
+        :return: dict or None
+        """
+        if self.index is None:
+            self.open()
+        entry = self.index[kind].get(filename.replace(os.sep, '/'))
+        if entry is not None and os.path.exists(filename):
+            stat = os.stat(filename)
+            if stat.st_size != entry['bytes'] or stat.st_mtime_ns != entry['mtime']:
+                return None
+        return entry
+
+    def surface(self, entry):
+        """
+        Make the surface over the pixels of the entry. When pixels are not in the display format
+        the surface is converted (copied)
+        :param entry: entry of the index
+        :return: surface, it is shared and must not be changed
+        """
+        width, height = entry['size']
+        pixels = self.pixels[entry['offset']:entry['offset'] + width * height * 4]
+        surface = pygame.image.frombuffer(pixels, (width, height), self.index['format'])
+        if pygame.display.get_surface() is not None:
+            if self.native is None:
+                self.native = surface.get_masks() == surface.convert_alpha().get_masks()
+            if not self.native:
+                surface = surface.convert_alpha()
+        return surface
+
+    def image(self, filename):
+        """
+        Get the picture from the pack
+        :param filename: path to the picture
+        :return: surface or None if it is not in the pack
+        """
+        entry = self.find('images', filename)
+        if entry is None:
+            return None
+        return self.surface(entry)
+
+    def animation(self, filename):
+        """
+        Get the frames of the GIF-file from the pack
+        :param filename: path to the GIF-file
+        :return: tuple of the frames (surface, duration) or None if it is not in the pack
+        """
+        entry = self.find('animations', filename)
+        if entry is None:
+            return None
+        strip = self.surface(entry)
+        return tuple((strip.subsurface(rect), duration) for *rect, duration in entry['frames'])
+
+    def stats(self):
+        """
+        Statistics of the pack
+        :return: dict with file name, count of images and animations
+        """
+        if self.index is None:
+            self.open()
+        return {'filename': self.filename if self.pixels is not None else None,
+                'images': len(self.index['images']), 'animations': len(self.index['animations'])}
+
+
+asset_pack = AssetPack()
+
+
+def load_image(name, colorkey=None, scale=None, angle=None):
+    """
+    Function for loading pictures from Images folders. Every picture is loaded from disk only
+    once, then it is taken from image_cache
     :param name: name of image which need to load
     :param colorkey: background color
-    :return: loaded image
+    :param scale: size (width, height) to which the image is scaled
+    :param angle: angle (in degrees) to which the image is rotated
+    :return: loaded image, it is shared and must not be changed
     """
-    fullname = os.path.join('Images', name)
-    image = pygame.image.load(fullname).convert()
-    if colorkey is not None:
-        if colorkey == -1:
-            colorkey = image.get_at((0, 0))
-        image.set_colorkey(colorkey)
-    else:
-        image = image.convert_alpha()
-    return image
+    return image_cache.get(name, colorkey, scale, angle)
+
+
+class ImageCache:
+    def __init__(self):
+        """
+        initialization of class ImageCache
+        """
+        self.images = {}
+        self.hits, self.misses = 0, 0
+
+    def get(self, name, colorkey=None, scale=None, angle=None):
+        """
+        Get the image. It is loaded (scaled, rotated) only when it is not in the cache
+        :param name: name of image in the Images folder
+        :param colorkey: background color (-1 - color of the top left pixel)
+        :param scale: size (width, height) to which the image is scaled
+        :param angle: angle (in degrees) to which the image is rotated
+        :return: shared image, it must not be changed
+        """
+        key = (name, colorkey, scale, angle)
+        image = self.images.get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+        self.misses += 1
+        if scale is None and angle is None:
+            image = self.load(name, colorkey)
+        else:
+            image = self.get(name, colorkey)
+            if scale is not None:
+                image = pygame.transform.scale(image, scale)
+            if angle is not None:
+                image = pygame.transform.rotate(image, angle)
+            if colorkey is not None:
+                image.set_colorkey(image.get_colorkey(), RLEACCEL)
+        self.images[key] = image
+        return image
+
+    @staticmethod
+    def load(name, colorkey=None):
+        """
+        Load the image (from the asset pack or from disk) and convert it to the format of the
+        display. Images with colorkey use RLE acceleration
+        :param name: name of image in the Images folder
+        :param colorkey: background color (-1 - color of the top left pixel)
+        :return: loaded image
+        """
+        fullname = os.path.join('Images', name)
+        image = asset_pack.image(fullname)
+        if image is None:
+            image = pygame.image.load(fullname)
+        image = image.convert()
+        if colorkey is not None:
+            if colorkey == -1:
+                colorkey = image.get_at((0, 0))
+            image.set_colorkey(colorkey, RLEACCEL)
+        return image
+
+    def clear(self):
+        """
+        Remove all images and reset counters
+        :return: None
+        """
+        self.images.clear()
+        self.hits, self.misses = 0, 0
+
+    def stats(self):
+        """
+        Statistics of the cache usage
+        :return: dict with size, hits, misses and hit rate
+        """
+        requests = self.hits + self.misses
+        return {'size': len(self.images), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0}
+
+
+image_cache = ImageCache()
 
 
-def get_frames(obj):
+def decode_gif(image):
     """
     Function for cutting GIF-files on frames
-    :param obj: GIF-file
-    :return: set of the frames
+    :param image: opened GIF-file
+    :return: tuple of the frames (surface, duration)
     """
-    image = obj.image_gif
+    frames = []
     pal = image.getpalette()
     base_palette = []
     for i in range(0, len(pal), 3):
@@ -96,14 +299,150 @@ def get_frames(obj):
                 pi.set_colorkey(image.info["transparency"])
             pi2 = pygame.Surface(image.size, SRCALPHA)
             if cons:
-                for i in obj.frames:
+                for i in frames:
                     pi2.blit(i[0], (0, 0))
             pi2.blit(pi, (x0, y0), (x0, y0, x1 - x0, y1 - y0))
+            if pygame.display.get_surface() is not None:
+                pi2 = pi2.convert_alpha()
 
-            obj.frames.append([pi2, duration])
+            frames.append((pi2, duration))
             image.seek(image.tell() + 1)
     except EOFError:
         pass
+    return tuple(frames)
+
+
+class AnimationCache:
+    def __init__(self, max_size=None):
+        """
+        initialization of class AnimationCache
+        :param max_size: how many animations can be stored at once (None - without limit)
+        """
+        self.max_size = max_size
+        self.animations = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, filename, image=None):
+        """
+        Get decoded frames of the GIF-file. When they are not in the cache, they are taken from
+        the asset pack or the file is decoded
+        :param filename: path to the GIF-file
+        :param image: already opened GIF-file (if None it will be opened here)
+        :return: shared tuple of the frames, it must not be changed
+        """
+        frames = self.animations.get(filename)
+        if frames is not None:
+            self.hits += 1
+            self.animations.move_to_end(filename)
+            return frames
+        self.misses += 1
+        if image is None:
+            frames = asset_pack.animation(filename)
+            if frames is None:
+                # Pillow is imported only when there is a file to decode (not with the pack)
+                from PIL import Image
+                frames = decode_gif(Image.open(filename))
+        else:
+            frames = decode_gif(image)
+        self.animations[filename] = frames
+        if self.max_size is not None:
+            while len(self.animations) > self.max_size:
+                self.animations.popitem(last=False)
+        return frames
+
+    def clear(self):
+        """
+        Remove all decoded animations and reset counters
+        :return: None
+        """
+        self.animations.clear()
+        self.hits, self.misses = 0, 0
+
+    def stats(self):
+        """
+        Statistics of the cache usage
+        :return: dict with size, hits, misses and hit rate
+        """
+        requests = self.hits + self.misses
+        return {'size': len(self.animations), 'max_size': self.max_size, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hits / requests if requests else 0}
+
+
+animation_cache = AnimationCache()
+
+# file suffixes of animations for every direction
+RUN_ANIMATIONS = {0: 'run_up.gif', 1: 'run_right.gif', 2: 'run_down.gif', 3: 'run_left.gif',
+                  -1: 'stay.gif'}
+DIRECTION_ANIMATIONS = {0: 'up.gif', 1: 'right.gif', 2: 'down.gif', 3: 'left.gif'}
+# logical name: (beginning of the file names, suffixes)
+ANIMATION_SETS = {
+    'Red': ('Images/Entities/Hero/Red_', RUN_ANIMATIONS),
+    'Red_run': ('Images/Entities/Hero/Red_run_', DIRECTION_ANIMATIONS),
+    'Cop': ('Images/Entities/Enemies/Cop_', RUN_ANIMATIONS),
+    'Cop_shoot': ('Images/Entities/Enemies/Cop_shoot_', DIRECTION_ANIMATIONS),
+    'boss_r': ('Images/Entities/Boss/boss_r_', RUN_ANIMATIONS),
+    'boss_shoot': ('Images/Entities/Boss/boss_shoot_', DIRECTION_ANIMATIONS),
+    'tear': ('Images/Bullets/tear_', DIRECTION_ANIMATIONS),
+    'bottle': ('Images/Bullets/bottle_', DIRECTION_ANIMATIONS)}
+
+
+class AssetRegistry:
+    def __init__(self, cache, animation_sets=ANIMATION_SETS):
+        """
+        initialization of class AssetRegistry
+        :param cache: animation cache where decoded frames are stored
+        :param animation_sets: logical names of the animation sets and their files
+        """
+        self.cache = cache
+        self.animation_sets = animation_sets
+        self.loaded = {}
+        self.files_opened, self.requests = 0, 0
+
+    def preload(self):
+        """
+        Load every known animation set, so entities do not open files when they spawn
+        :return: None
+        """
+        for name in self.animation_sets:
+            self.get(name)
+
+    def load(self, name):
+        """
+        Decode all files of the animation set
+        :param name: logical name of the animation set
+        :return: dict direction: frames
+        """
+        file_start, suffixes = self.animation_sets[name]
+        animations = {}
+        for direction, suffix in suffixes.items():
+            misses = self.cache.misses
+            animations[direction] = self.cache.get(file_start + suffix)
+            self.files_opened += self.cache.misses - misses
+        return animations
+
+    def get(self, name):
+        """
+        Get the animation set by its logical name
+        :param name: logical name of the animation set ("Cop", "boss_r", "Red", "tear"...)
+        :return: dict direction: frames, it is shared between entities and must not be changed
+        """
+        self.requests += 1
+        if name not in self.loaded:
+            self.loaded[name] = self.load(name)
+        return self.loaded[name]
+
+    def stats(self):
+        """
+        Statistics of the registry usage
+        :return: dict with loaded sets, opened files and requests
+        """
+        return {'sets': len(self.loaded), 'files_opened': self.files_opened,
+                'requests': self.requests}
+
+
+# coordinate changes for the directions right, down, left and up
+DELTA_X = [1, 0, -1, 0]
+DELTA_Y = [0, 1, 0, -1]
 
 
 def get_coords(coords, direction):
@@ -123,12 +462,31 @@ def get_coords(coords, direction):
         return coords[0] - 1, coords[1]
 
 
+# name: (file in the Sounds folder, volume)
+SOUNDS = {
+    'artifact_get': ('Gulmen_Gde_zhe_etot_artefakt.wav', 0.6),
+    'hero_ouch': ('Hero_ouch.wav', 0.1),
+    'enemy_ouch': ('Enemy_ouch.wav', 0.05),
+    'hero_shoot': ('Hero_throw.ogg', 0.1),
+    'enemy_shoot': ('Enemy_shoot.wav', 0.01)}
+# minimal time in seconds between two plays of the same sound
+SOUNDS_RETRIGGER = {
+    'artifact_get': 0,
+    'hero_ouch': 0.2,
+    'enemy_ouch': 0.1,
+    'hero_shoot': 0.05,
+    'enemy_shoot': 0.15}
+# how many mixer channels are reserved for the sound effects
+VOICES_COUNT = 8
+
+
 class MusicAndSounds:
-    def __init__(self, volume_coeff=1, music_coeff=1):
+    def __init__(self, volume_coeff=1, music_coeff=1, voices_count=VOICES_COUNT):
         """
         initialization of class MusicAndSounds
         :param volume_coeff: volume ratio
         :param music_coeff: music ratio
+        :param voices_count: how many sound effects can be played at the same time
         """
         pygame.mixer.init()
         self.sound_path = 'Sounds/'
@@ -138,6 +496,90 @@ class MusicAndSounds:
         self.music_coeff = music_coeff
         self.queue = []
 
+        if pygame.mixer.get_num_channels() < voices_count:
+            pygame.mixer.set_num_channels(voices_count)
+        pygame.mixer.set_reserved(voices_count)
+        self.voices = [pygame.mixer.Channel(i) for i in range(voices_count)]
+        self.next_voice = 0
+        self.loads, self.plays, self.steals = 0, 0, 0
+        self.requests, self.coalesced, self.limited = 0, 0, 0
+        self.requested, self.last_played = {}, {}
+        self.sounds = {}
+        self.load_sounds()
+
+    def load_sounds(self):
+        """
+        Load all sound effects in the cache
+        :return: None
+        """
+        for name, (filename, volume) in SOUNDS.items():
+            self.sounds[name] = (pygame.mixer.Sound(self.sound_path + filename), volume)
+            self.loads += 1
+
+    def get_voice(self):
+        """
+        Find a free reserved channel. If all channels are busy the oldest one is taken
+        :return: channel
+        """
+        for i in range(len(self.voices)):
+            index = (self.next_voice + i) % len(self.voices)
+            if not self.voices[index].get_busy():
+                self.next_voice = (index + 1) % len(self.voices)
+                return self.voices[index]
+        voice = self.voices[self.next_voice]
+        self.next_voice = (self.next_voice + 1) % len(self.voices)
+        self.steals += 1
+        return voice
+
+    def play(self, name):
+        """
+        Play the sound effect from the cache
+        :param name: name of the sound from SOUNDS
+        :return: None
+        """
+        sound, volume = self.sounds[name]
+        voice = self.get_voice()
+        voice.play(sound)
+        voice.set_volume(volume * self.volume_coeff)
+        self.plays += 1
+
+    def request(self, name):
+        """
+        Ask to play the sound effect in this frame. Same requests in one frame are played once
+        :param name: name of the sound from SOUNDS
+        :return: None
+        """
+        self.requests += 1
+        if name in self.requested:
+            self.coalesced += 1
+        else:
+            self.requested[name] = True
+
+    def flush(self):
+        """
+        Play the sounds requested in this frame. It must be called once per frame
+        :return: None
+        """
+        if not self.requested:
+            return
+        now = time.time()
+        for name in self.requested:
+            if now - self.last_played.get(name, 0) >= SOUNDS_RETRIGGER[name]:
+                self.last_played[name] = now
+                self.play(name)
+            else:
+                self.limited += 1
+        self.requested.clear()
+
+    def stats(self):
+        """
+        Statistics of the sound effects
+        :return: dict with loads, plays, voice steals and skipped requests
+        """
+        return {'loads': self.loads, 'plays': self.plays, 'steals': self.steals,
+                'voices': len(self.voices), 'requests': self.requests,
+                'coalesced': self.coalesced, 'limited': self.limited}
+
     def menu(self):
         """
         Start play music in menu.
@@ -182,9 +624,7 @@ class MusicAndSounds:
         Function for play sound when hero pick up the artifact
         :return: None
         """
-        sound = pygame.mixer.Sound(self.sound_path + 'Gulmen_Gde_zhe_etot_artefakt.wav')
-        sound.play()
-        sound.set_volume(0.6 * self.volume_coeff)
+        self.request('artifact_get')
 
     def ouch(self, entity):
         """
@@ -192,13 +632,7 @@ class MusicAndSounds:
         :param entity: who got hit
         :return: None
         """
-        if entity == 'hero':
-            sound = pygame.mixer.Sound(self.sound_path + 'Hero_ouch.wav')
-            sound.set_volume(0.1 * self.volume_coeff)
-        elif entity == 'enemy':
-            sound = pygame.mixer.Sound(self.sound_path + 'Enemy_ouch.wav')
-            sound.set_volume(0.05 * self.volume_coeff)
-        sound.play()
+        self.request(entity + '_ouch')
 
     def shoot(self, entity):
         """
@@ -206,13 +640,7 @@ class MusicAndSounds:
         :param entity: who got hit
         :return:
         """
-        if entity == 'hero':
-            sound = pygame.mixer.Sound(self.sound_path + 'Hero_throw.ogg')
-            sound.set_volume(0.1 * self.volume_coeff)  # TODO пофиксить воспроизведение
-        elif entity == 'enemy':
-            sound = pygame.mixer.Sound(self.sound_path + 'Enemy_shoot.wav')
-            sound.set_volume(0.01 * self.volume_coeff)
-        sound.play()
+        self.request(entity + '_shoot')
 
 
 class Button(pygame.sprite.Sprite):
@@ -241,37 +669,755 @@ class Button(pygame.sprite.Sprite):
         self.clicked_func = clicked_func
         self.rect = self.image.get_rect().move(x, y)
 
+    def set_images(self, image, selected_image):
+        """
+        Change the images of the button (the selection does not change)
+        :param image: Image that displays an unselected button
+        :param selected_image: Image that displays an selected button
+        :return: None
+        """
+        selected = self.image is self.selected_image
+        self.not_selected_image = load_image(image)
+        self.selected_image = load_image(selected_image)
+        self.image = self.selected_image if selected else self.not_selected_image
+
     def check_mouse_pos(self, pos):
         """
         Function is checking a mouse position and if it collide the button rectangle image change
         :param pos: mouse position
-        :return: None
+        :return: True if the image is changed
         """
+        image = self.image
         if self.rect.collidepoint(pos):
             self.image = self.selected_image
         else:
             self.image = self.not_selected_image
+        return self.image is not image
 
     def check_click(self, pos):
         """
         Function is checking a mouse position and called a function if button clicked
         :param pos: mouse position
-        :return: None
+        :return: what the function returns (transition to another screen) or None
         """
         if self.rect.collidepoint(pos):
             if self.clicked_func:
-                if self.clicked_func():
-                    return True
+                return self.clicked_func()
+        return None
+
+
+# event which wakes up an idle menu screen (it waits for events instead of drawing every frame)
+MENU_WAKEUP = pygame.USEREVENT + 1
+# how often (in milliseconds) an idle menu screen wakes up to check the music. The timer is
+# started once and not stopped: the game ignores these events, and pygame 2 keeps some memory
+# on every set_timer call
+MENU_WAKEUP_TIME = 250
+
+
+class Scene:
+    def __init__(self, main):
+        """
+        initialization of class Scene. Scene is one screen of the game (menu, settings, game...).
+        Scenes do not call each other, they return transitions which Main.run applies to the
+        stack of scenes: ('push', scene), ('pop',), ('replace', scene) or ('reset', scene)
+        :param main: parameter for accessing the main class
+        """
+        self.main = main
+
+    def enter(self):
+        """
+        Called when the scene becomes the top of the stack (also after the scene above is closed)
+        :return: None
+        """
+
+    def update(self):
+        """
+        One frame of the scene
+        :return: transition or None
+        """
+        return None
+
+
+class ButtonsScene(Scene):
+    music_stage = 'menu'
+
+    def __init__(self, main):
+        """
+        initialization of class ButtonsScene. It is a base of the screens with buttons.
+        The buttons and texts are created on the first enter and reused after
+        :param main: parameter for accessing the main class
+        """
+        super().__init__(main)
+        self.buttons_group, self.texts = None, []
+
+    def enter(self):
+        """
+        Draw the background, the texts and the buttons of the screen
+        :return: None
+        """
+        pygame.mouse.set_visible(1)
+        if not self.main.menu_wakeup:
+            pygame.time.set_timer(MENU_WAKEUP, MENU_WAKEUP_TIME)
+            self.main.menu_wakeup = True
+        if self.buttons_group is None:
+            self.buttons_group = pygame.sprite.Group()
+            self.create_buttons()
+        self.refresh()
+        mouse_pos = pygame.mouse.get_pos()
+        for button in self.buttons_group:
+            button.check_mouse_pos(mouse_pos)
+        self.main.screen.blit(self.main.menu_background(), (0, 0))
+        for text_rendered, pos in self.texts:
+            self.main.screen.blit(text_rendered, pos)
+        self.draw()
+
+    def create_buttons(self):
+        """
+        Create the buttons and render the texts of the screen (only once)
+        :return: None
+        """
+
+    def refresh(self):
+        """
+        Update the images of the buttons which depend on the settings
+        :return: None
+        """
+
+    def draw(self):
+        """
+        Draw the buttons over the background and show the screen
+        :return: None
+        """
+        background = self.main.menu_background()
+        for button in self.buttons_group:
+            self.main.screen.blit(background, button.rect, button.rect)
+        self.buttons_group.draw(self.main.screen)
+        pygame.display.flip()
+
+    def key_down(self, key):
+        """
+        Key pressed on the screen
+        :param key: pygame key
+        :return: transition or None
+        """
+        return None
+
+    def update(self):
+        """
+        Wait for the events (or MENU_WAKEUP) and handle them. The buttons are drawn again only
+        when the mouse selects or unselects one of them or clicks
+        :return: transition of the clicked button or None
+        """
+        transition, changed = None, False
+        events = [pygame.event.wait()]
+        events.extend(pygame.event.get())
+        for event in events:
+            if event.type == pygame.QUIT:
+                self.main.terminate()
+            if event.type == pygame.MOUSEMOTION:
+                for button in self.buttons_group:
+                    if button.check_mouse_pos(event.pos):
+                        changed = True
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                changed = True
+                for elem in self.buttons_group:
+                    transition = elem.check_click(event.pos) or transition
+            elif event.type == pygame.KEYDOWN:
+                transition = self.key_down(event.key) or transition
+        self.main.music.check_stream(self.music_stage)
+        self.main.music.flush()
+        if changed and transition is None:
+            self.draw()
+        return transition
+
+
+class MenuScene(ButtonsScene):
+    def __init__(self, main):
+        """
+        initialization of class MenuScene
+        :param main: parameter for accessing the main class
+        """
+        super().__init__(main)
+        self.diff_button = None
+
+    def enter(self):
+        """
+        Show a menu screen and starts playing music in the menu
+        :return: None
+        """
+        self.main.music.menu()
+        super().enter()
+
+    def create_buttons(self):
+        main = self.main
+        Button(main.screen, self.buttons_group, 250, 150, "Buttons/Start_button.png",
+               "Buttons/Start_selected_button.png", False, main.start_game)
+        self.diff_button = Button(main.screen, self.buttons_group, 450, 375,
+                                  'Buttons/' + main.diff_stages[main.diff_image],
+                                  'Buttons/' + main.diff_stages[main.diff_image], False, None)
+        Button(main.screen, self.buttons_group, 250, 250, "Buttons/Setting_button.png",
+               "Buttons/Setting_selected_button.png", False, main.settings)
+        Button(main.screen, self.buttons_group, 250, 350, "Buttons/Autors_button.png",
+               "Buttons/Autors_selected_button.png", False, main.autors_show)
+        Button(main.screen, self.buttons_group, 250, 450, "Buttons/Exit_button.png",
+               "Buttons/Exit_selected_button.png", False, main.terminate)
+
+    def refresh(self):
+        main = self.main
+        self.diff_button.set_images('Buttons/' + main.diff_stages[main.diff_image],
+                                    'Buttons/' + main.diff_stages[main.diff_image])
+
+
+class SettingsScene(ButtonsScene):
+    def __init__(self, main):
+        """
+        initialization of class SettingsScene
+        :param main: parameter for accessing the main class
+        """
+        super().__init__(main)
+        self.volume_button, self.music_button, self.diff_button = None, None, None
+        self.back_button, self.continue_button = None, None
+
+    def create_buttons(self):
+        main = self.main
+        # Volume
+        Button(main.screen, self.buttons_group, 215, 150, "Buttons/vol_button.png",
+               "Buttons/vol_selected_button.png", False, None)
+        Button(main.screen, self.buttons_group, 325, 150, "Buttons/settings_left_button.png",
+               "Buttons/settings_left_selected_button.png", False, main.change_settings_sound_low)
+        Button(main.screen, self.buttons_group, 575, 150, "Buttons/settings_right_button.png",
+               "Buttons/settings_right_selected_button.png", False,
+               main.change_settings_sound_high)
+        self.volume_button = Button(main.screen, self.buttons_group, 365, 150,
+                                    'Buttons/' + main.volume_stages[main.vol_set_image],
+                                    'Buttons/' + main.volume_stages[main.vol_set_image], False,
+                                    None)
+        # Music
+        Button(main.screen, self.buttons_group, 215, 250, "Buttons/mus_button.png",
+               "Buttons/mus_selected_button.png", False, None)
+        Button(main.screen, self.buttons_group, 325, 250, "Buttons/settings_left_button.png",
+               "Buttons/settings_left_selected_button.png", False, main.change_settings_music_low)
+        Button(main.screen, self.buttons_group, 575, 250, "Buttons/settings_right_button.png",
+               "Buttons/settings_right_selected_button.png", False,
+               main.change_settings_music_high)
+        self.music_button = Button(main.screen, self.buttons_group, 365, 250,
+                                   'Buttons/' + main.volume_stages[main.mus_set_image],
+                                   'Buttons/' + main.volume_stages[main.mus_set_image], False,
+                                   None)
+        # Difficulty
+        self.diff_button = Button(main.screen, self.buttons_group, 450, 375,
+                                  'Buttons/' + main.diff_stages[main.diff_image],
+                                  'Buttons/' + main.selected_diff_stages[main.diff_image], False,
+                                  main.change_settings_difficult)
+        self.back_button = Button(main.screen, self.buttons_group, 275, 425,
+                                  "Buttons/Back_button.png", "Buttons/Back_selected_button.png",
+                                  False, main.stop)
+        self.continue_button = Button(main.screen, self.buttons_group, 250, 450,
+                                      "Buttons/Continue_button.png",
+                                      "Buttons/Continue_selected_button.png", False, main.stop)
+
+        # TODO сделай так чтобы можно было вписать нужную папку или просто выбрать
+        #  между двумя папками (или папками которые находятся в Sounds)
+
+        # Прибавить\убавить звук в игре(без звука\тихо\норма\громко\бассбустед)
+        # Прибавить\убавить музыку
+        # Сложность (для детей\средний\для профи)
+        # Плейлист (имя папки с музыкой в папке Sounds, где все файлы в формате mp3, wav или ogg)
+
+    def refresh(self):
+        main = self.main
+        self.volume_button.set_images('Buttons/' + main.volume_stages[main.vol_set_image],
+                                      'Buttons/' + main.volume_stages[main.vol_set_image])
+        self.music_button.set_images('Buttons/' + main.volume_stages[main.mus_set_image],
+                                     'Buttons/' + main.volume_stages[main.mus_set_image])
+        self.diff_button.set_images('Buttons/' + main.diff_stages[main.diff_image],
+                                    'Buttons/' + main.selected_diff_stages[main.diff_image])
+        if not main.game_in_process:
+            self.continue_button.kill()
+            self.back_button.add(self.buttons_group)
+        else:
+            self.back_button.kill()
+            self.continue_button.add(self.buttons_group)
+
+
+class AuthorsScene(ButtonsScene):
+    def create_buttons(self):
+        main = self.main
+        text = "Урвачев Роман и Зотова Екатерина"
+        font = pygame.font.Font(None, 30)
+        text_rendered = font.render(text, 1, pygame.Color('black'))
+        self.texts.append((text_rendered, (250, 250)))
+        Button(main.screen, self.buttons_group, 250, 300, "Buttons/Start_button.png",
+               "Buttons/Start_selected_button.png", False, main.start_game)
+        Button(main.screen, self.buttons_group, 275, 425, "Buttons/Back_button.png",
+               "Buttons/Back_selected_button.png", False, main.stop)
+
+
+class PauseScene(ButtonsScene):
+    music_stage = 'game'
+
+    def __init__(self, main):
+        """
+        initialization of class PauseScene
+        :param main: parameter for accessing the main class
+        """
+        super().__init__(main)
+        self.diff_button = None
+
+    def create_buttons(self):
+        main = self.main
+        self.diff_button = Button(main.screen, self.buttons_group, 450, 375,
+                                  'Buttons/' + main.diff_stages[main.diff_image],
+                                  'Buttons/' + main.diff_stages[main.diff_image], False, None)
+        Button(main.screen, self.buttons_group, 250, 150, "Buttons/Continue_button.png",
+               "Buttons/Continue_selected_button.png", False, main.stop)
+        Button(main.screen, self.buttons_group, 250, 250, "Buttons/Setting_button.png",
+               "Buttons/Setting_selected_button.png", False, main.settings)
+        Button(main.screen, self.buttons_group, 250, 350, "Buttons/Exit_button.png",
+               "Buttons/Exit_selected_button.png", False, main.terminate)
+
+    def refresh(self):
+        main = self.main
+        self.diff_button.set_images('Buttons/' + main.diff_stages[main.diff_image],
+                                    'Buttons/' + main.diff_stages[main.diff_image])
+
+    def key_down(self, key):
+        if key == pygame.K_ESCAPE:
+            return self.main.stop()
+        return None
+
+
+class GameOverScene(ButtonsScene):
+    def create_buttons(self):
+        main = self.main
+        text = "Гамовер"
+        font = pygame.font.Font(None, 100)
+        text_rendered = font.render(text, 1, pygame.Color('black'))
+        self.texts.append((text_rendered, (250, 175)))
+        Button(main.screen, self.buttons_group, 250, 250, "Buttons/Continue_button.png",
+               "Buttons/Continue_selected_button.png", False, main.start_game)
+        Button(main.screen, self.buttons_group, 250, 350, "Buttons/Setting_button.png",
+               "Buttons/Setting_selected_button.png", False, main.settings)
+        Button(main.screen, self.buttons_group, 250, 450, "Buttons/Exit_button.png",
+               "Buttons/Exit_selected_button.png", False, main.terminate)
+
+
+class CongratulationsScene(ButtonsScene):
+    def create_buttons(self):
+        main = self.main
+        Button(main.screen, self.buttons_group, 250, 350, "Buttons/Start_button.png",
+               "Buttons/Start_selected_button.png", False, main.start_game)
+        Button(main.screen, self.buttons_group, 350, 175, "Artifacts/Winner.png",
+               "Artifacts/Winner.png", False, main.start_game)
+        Button(main.screen, self.buttons_group, 350, 425, "Buttons/Back_button.png",
+               "Buttons/Back_selected_button.png", False, main.menu)
+
+
+class GameScene(Scene):
+    def enter(self):
+        """
+        Hide the mouse and redraw the whole game screen (it was covered by the menus)
+        :return: None
+        """
+        pygame.mouse.set_visible(0)
+        self.main.renderer.invalidate()
+
+    def update(self):
+        """
+        One frame of the game
+        :return: transition or None
+        """
+        return self.main.run_frame()
+
+
+class Renderer:
+    def __init__(self, screen, dirty_rects=False):
+        """
+        initialization of class Renderer
+        :param screen: screen where the game is drawn
+        :param dirty_rects: update only changed areas of the screen instead of the whole screen
+        """
+        self.screen = screen
+        self.dirty_rects = dirty_rects
+        self.room = None
+        self.full_update = True
+        self.previous_rects, self.rects = [], []
+        self.door_images = {}
+
+    def invalidate(self):
+        """
+        Redraw and update the whole screen in the next frame (after menus and room loading)
+        :return: None
+        """
+        self.full_update = True
+
+    def add_rect(self, rect):
+        """
+        Mark the area of the screen as changed (for overlays like map and stats)
+        :param rect: changed area
+        :return: None
+        """
+        if self.dirty_rects:
+            self.rects.append(pygame.Rect(rect))
+
+    def draw(self, room, groups):
+        """
+        Draw the room and sprites. In dirty rectangles mode only areas where sprites were in
+        the previous frame are restored from the room background
+        :param room: current room
+        :param groups: sprite groups (and the bullet engine) in drawing order
+        :return: None
+        """
+        if not self.dirty_rects:
+            room.draw_background(self.screen)
+            for group in groups:
+                group.draw(self.screen)
+            return
+        if room is not self.room:
+            self.room, self.full_update = room, True
+            self.door_images = {}
+        if self.full_update:
+            self.screen.blit(room.background, (0, 0))
+        else:
+            for rect in self.previous_rects:
+                self.screen.blit(room.background, rect, rect)
+        for door in room.tiles_group:
+            self.screen.blit(door.image, door.rect)
+            if self.door_images.get(door) is not door.image:
+                self.door_images[door] = door.image
+                self.rects.append(door.rect.copy())
+        for group in groups:
+            if isinstance(group, BulletEngine):
+                self.rects.extend(group.draw(self.screen))
+                continue
+            for sprite in group:
+                self.rects.append(self.screen.blit(sprite.image, sprite.rect))
+
+    def update(self):
+        """
+        Show the drawn frame on the display
+        :return: None
+        """
+        if not self.dirty_rects or self.full_update:
+            pygame.display.flip()
+            self.full_update = False
+        else:
+            pygame.display.update(self.previous_rects + self.rects)
+        self.previous_rects, self.rects = self.rects, []
+
+
+# how many last frames are used for the timings overlay
+TIMINGS_WINDOW = 250
+# how often (in frames) the timings overlay is updated
+TIMINGS_REFRESH = 25
+# how many frames are profiled after F9 (or PUNKS_PROFILE_FRAMES environment variable)
+PROFILE_FRAMES = 100
+# keys which are used in the game (they are saved when the input is recorded)
+GAME_KEYS = ['w', 'a', 's', 'd', 'UP', 'RIGHT', 'DOWN', 'LEFT', 'TAB', 'LSHIFT', 'ESCAPE', 'r']
+
+
+def environment_number(name, default, minimum=0):
+    """
+    Read the integer setting from the environment variable. A bad value does not stop the game:
+    it is reported and the default is used
+    :param name: name of the environment variable
+    :param default: value when the variable is not set or is bad
+    :param minimum: the smallest allowed value
+    :return: integer
+    """
+    value = os.environ.get(name, '').strip()
+    if not value:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < minimum:
+        print('Неверное значение {}={!r} (нужно целое число не меньше {}), используется {}'.format(
+            name, value, minimum, default))
+        return default
+    return number
+
+
+class PressedKeys:
+    def __init__(self, keys):
+        """
+        initialization of class PressedKeys. It works like pygame.key.get_pressed()
+        :param keys: set of the pressed key codes
+        """
+        self.keys = keys
+
+    def __getitem__(self, key):
+        return 1 if key in self.keys else 0
+
+
+class KeyboardInput:
+    def poll(self):
+        """
+        Get input of the current frame from the keyboard
+        :return: list of events and pressed keys
+        """
+        return pygame.event.get(), pygame.key.get_pressed()
+
+
+class InputRecorder(KeyboardInput):
+    def __init__(self, filename):
+        """
+        initialization of class InputRecorder. It saves the keyboard input for ScriptedInput
+        :param filename: file where the input is saved
+        """
+        self.filename = filename
+        self.frames = []
+
+    def poll(self):
+        events, keys = super().poll()
+        self.frames.append(tuple(name for name in GAME_KEYS
+                                 if keys[getattr(pygame, 'K_' + name)]))
+        return events, keys
+
+    def save(self):
+        """
+        Save the recorded input in the script format
+        :return: None
+        """
+        with open(self.filename, 'w') as script:
+            count = 0
+            for i in range(len(self.frames)):
+                count += 1
+                if i + 1 == len(self.frames) or self.frames[i + 1] != self.frames[i]:
+                    script.write(' '.join([str(count)] + list(self.frames[i])) + '\n')
+                    count = 0
+
+
+class ScriptedInput:
+    def __init__(self, frames=()):
+        """
+        initialization of class ScriptedInput. Keys are taken from the script, not keyboard
+        :param frames: list of (frames count, key names) - which keys are pressed and how long
+        """
+        self.frames = []
+        for count, names in frames:
+            keys = frozenset(getattr(pygame, 'K_' + name) for name in names)
+            self.frames.extend([keys] * count)
+        self.current = 0
+        self.pressed = frozenset()
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the script. Every line is: frames count and names of pressed keys,
+        for example "40 d UP" (names are the same as in pygame without K_)
+        :param filename: name of the script file
+        :return: ScriptedInput
+        """
+        frames = []
+        with open(filename, 'r') as script:
+            for line in script:
+                line = line.split('#')[0].split()
+                if line:
+                    frames.append((int(line[0]), line[1:]))
+        return cls(frames)
+
+    def poll(self):
+        """
+        Get input of the current frame from the script. When the script ends nothing is pressed
+        :return: list of events and pressed keys
+        """
+        if self.current < len(self.frames):
+            pressed = self.frames[self.current]
+        else:
+            pressed = frozenset()
+        self.current += 1
+        events = [pygame.event.Event(pygame.KEYDOWN, key=key) for key in pressed - self.pressed]
+        events += [pygame.event.Event(pygame.KEYUP, key=key) for key in self.pressed - pressed]
+        self.pressed = pressed
+        return events, PressedKeys(pressed)
+
+
+class PhaseTimer:
+    def __init__(self, window=TIMINGS_WINDOW):
+        """
+        initialization of class PhaseTimer. It measures how long every phase of the frame takes
+        :param window: how many last frames are used for rolling average and percentiles
+        """
+        self.window = window
+        self.totals, self.counts, self.windows, self.frames = {}, {}, {}, 0
+        self.frame_start, self.last = None, time.perf_counter()
+
+    def start(self):
+        """
+        Start measuring of the new frame. Time of the whole previous frame is saved as "frame"
+        :return: None
+        """
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.add('frame', now - self.frame_start)
+        self.frames += 1
+        self.frame_start = self.last = now
+
+    def mark(self, phase):
+        """
+        End the phase. Its time is counted from the previous mark
+        :param phase: name of the phase
+        :return: None
+        """
+        now = time.perf_counter()
+        self.add(phase, now - self.last)
+        self.last = now
+
+    def add(self, phase, seconds):
+        """
+        Save the time of the phase
+        :param phase: name of the phase
+        :param seconds: time of the phase
+        :return: None
+        """
+        if phase not in self.totals:
+            self.totals[phase], self.counts[phase] = 0, 0
+            self.windows[phase] = deque(maxlen=self.window)
+        self.totals[phase] += seconds
+        self.counts[phase] += 1
+        self.windows[phase].append(seconds)
+
+    def reset(self):
+        """
+        Forget all measurements
+        :return: None
+        """
+        self.totals, self.counts, self.windows, self.frames = {}, {}, {}, 0
+        self.frame_start = None
+
+    def means(self):
+        """
+        Mean time of every phase
+        :return: dict phase: milliseconds per frame
+        """
+        return {phase: total * 1000 / self.frames for phase, total in self.totals.items()
+                if phase != 'frame'}
+
+    def rolling(self):
+        """
+        Rolling average, 95 and 99 percentiles of every phase in the last frames
+        :return: dict phase: (average, p95, p99) in milliseconds
+        """
+        result = {}
+        for phase, window in self.windows.items():
+            values = sorted(window)
+            result[phase] = (sum(values) * 1000 / len(values),
+                             values[min(len(values) - 1, int(len(values) * 0.95))] * 1000,
+                             values[min(len(values) - 1, int(len(values) * 0.99))] * 1000)
+        return result
+
+    def save_csv(self, filename):
+        """
+        Save the timings of all phases to the CSV-file
+        :param filename: name of the file
+        :return: None
+        """
+        rolling = self.rolling()
+        with open(filename, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['phase', 'count', 'mean_ms', 'rolling_mean_ms', 'p95_ms', 'p99_ms'])
+            for phase, total in self.totals.items():
+                writer.writerow([phase, self.counts[phase],
+                                 '%.4f' % (total * 1000 / self.counts[phase])] +
+                                ['%.4f' % value for value in rolling[phase]])
+
+
+class FrameProfiler:
+    def __init__(self, frames=PROFILE_FRAMES):
+        """
+        initialization of class FrameProfiler. It profiles a few frames of the running game
+        :param frames: how many frames are profiled after request
+        """
+        self.frames = frames
+        self.frames_left = 0
+        self.profile, self.filename = None, None
+
+    def request(self, frames=None):
+        """
+        Profile the next frames
+        :param frames: how many frames need to profile (default - self.frames)
+        :return: None
+        """
+        if not self.frames_left:
+            self.frames_left = frames or self.frames
+
+    def run(self, main):
+        """
+        Profile one frame of the game. When all frames are profiled the stats are saved
+        :param main: parameter for accessing the main class
+        :return: transition of the frame
+        """
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.filename = 'profile_{}_{}enemies_{}bullets_{}.pstats'.format(
+                main.room.filename, len(main.enemy_group), len(main.bullets),
+                time.strftime('%Y%m%d_%H%M%S'))
+        self.profile.enable()
+        transition = main.step()
+        self.profile.disable()
+        self.frames_left -= 1
+        if not self.frames_left:
+            self.save()
+        return transition
+
+    def save(self):
+        """
+        Save the stats of the profiled frames (also when the game exits before all requested
+        frames are profiled)
+        :return: None
+        """
+        if self.profile is None:
+            return
+        self.profile.dump_stats(self.filename)
+        print('Профиль сохранён в', self.filename)
+        self.profile, self.frames_left = None, 0
 
 
 class Main:
-    def __init__(self):
+    def __init__(self, headless=False, seed=None, input_script=None, record=None,
+                 timings_csv=None, dirty_rects=None):
+        """
+        initialization of class Main
+        :param headless: run the game without menus and frame limiter (for measurements)
+        :param seed: seed of the random generator for maps and artifacts
+        :param input_script: file with the input script, it is used instead of keyboard
+        :param record: file where the keyboard input is recorded
+        :param timings_csv: file where the timings of the frame phases are saved on exit
+        :param dirty_rects: update only changed areas of the screen (None - PUNKS_DIRTY_RECTS
+                            environment variable or DIRTY_RENDERING)
+        """
+        self.headless = headless
+        self.rng = Random(seed)
+        if input_script is not None:
+            self.input = ScriptedInput.load(input_script)
+        elif headless:
+            self.input = ScriptedInput()
+        elif record is not None:
+            self.input = InputRecorder(record)
+        else:
+            self.input = KeyboardInput()
+        self.timer = PhaseTimer()
+        self.profiler = FrameProfiler(environment_number('PUNKS_PROFILE_FRAMES', PROFILE_FRAMES, 1))
+        self.timings_csv = timings_csv
+        self.timings_shown, self.timings_font, self.timings_lines = False, None, []
         self.music = MusicAndSounds()
         self.size = self.WIDTH, self.HEIGHT = 850, 650
         self.screen = pygame.display.set_mode(self.size)
+        if dirty_rects is None:
+            dirty_rects = environment_number('PUNKS_DIRTY_RECTS', int(DIRTY_RENDERING)) > 0
+        self.renderer = Renderer(self.screen, dirty_rects)
         self.clock = pygame.time.Clock()
-        self.player_image_file = 'Images/Entities/Hero/Red_'
-        self.player_shoot_file = 'Images/Entities/Hero/Red_run_'
+        self.assets = AssetRegistry(animation_cache)
+        self.assets.preload()
+        self.levels = LevelLibrary()
+        self.levels.load()
+        self.prefetcher = RoomPrefetcher()
+        self.ai = AIScheduler(environment_number('PUNKS_AI_BUDGET', AI_BUDGET),
+                              AI_DECISION_COST if headless else None)
+        self.player_animation = 'Red'
+        self.player_shoot_animation = 'Red_run'
         self.vol_set_image, self.mus_set_image = 2, 2
         self.volume_stages = ['sound_0_button.png', 'sound_1_button.png', 'sound_2_button.png',
                               'sound_3_button.png', 'sound_4_button.png']
@@ -281,31 +1427,25 @@ class Main:
                                      'hard_diff_selected_button.png']
         self.diff_image = 1
         self.cell_size, self.player_size_x, self.player_size_y = 50, 50, 50
+        cell = (self.cell_size, self.cell_size)
         self.tile_images = {
-            'wall': pygame.transform.scale(load_image('Tiles/wall.png'),
-                                           (self.cell_size, self.cell_size)),
-            'empty': pygame.transform.scale(load_image('Tiles/floor.png'),
-                                            (self.cell_size, self.cell_size)),
-            'door_up': pygame.transform.scale(load_image('Tiles/door.png'),
-                                              (self.cell_size, self.cell_size)),
-            'door_right': pygame.transform.rotate(load_image('Tiles/door.png'), 270),
-            'door_down': pygame.transform.rotate(load_image('Tiles/door.png'), 180),
-            'door_left': pygame.transform.rotate(load_image('Tiles/door.png'), 90),
-            'door_up_closed': pygame.transform.scale(load_image('Tiles/door_closed.png'),
-                                                     (self.cell_size, self.cell_size)),
-            'door_right_closed': pygame.transform.rotate(load_image('Tiles/door_closed.png'), 270),
-            'door_down_closed': pygame.transform.rotate(load_image('Tiles/door_closed.png'), 180),
-            'door_left_closed': pygame.transform.rotate(load_image('Tiles/door_closed.png'), 90),
-            'hole': pygame.transform.scale(load_image('Tiles/hole.png'),
-                                           (self.cell_size, self.cell_size)),
-            'rock': pygame.transform.scale(load_image('Tiles/rock.png', -1),
-                                           (self.cell_size, self.cell_size))}
+            'wall': load_image('Tiles/wall.png', scale=cell),
+            'empty': load_image('Tiles/floor.png', scale=cell),
+            'door_up': load_image('Tiles/door.png', scale=cell),
+            'door_right': load_image('Tiles/door.png', angle=270),
+            'door_down': load_image('Tiles/door.png', angle=180),
+            'door_left': load_image('Tiles/door.png', angle=90),
+            'door_up_closed': load_image('Tiles/door_closed.png', scale=cell),
+            'door_right_closed': load_image('Tiles/door_closed.png', angle=270),
+            'door_down_closed': load_image('Tiles/door_closed.png', angle=180),
+            'door_left_closed': load_image('Tiles/door_closed.png', angle=90),
+            'hole': load_image('Tiles/hole.png', scale=cell),
+            'rock': load_image('Tiles/rock.png', -1, cell)}
         self.tile_width, self.tile_height = 50, 50
 
         self.room_types = ["circle", "circle_in_square", "death_road", "diagonal", "lines", "mexico",
                            "square_trap", "trapezoid", 'loner', 'tiger', 'punks_and_rocks', 'house',
                            'rocks', 'pyramid', 'lizard', 'romb', 'boloto']
-        self.running = True
         # player_hp\boss_hp\enemy_hp\enemy_shoot_speed\enemy_speed
         self.diff_parameters = [[12, 100, 25, 60, 1], [6, 200, 50, 10, 2], [6, 350, 65, 5, 4]]
         # player_speed\player_damage_coeff\player_damage\bullet_speed\shooting_ticks\hp\change_player
@@ -337,15 +1477,19 @@ class Main:
         self.shooting_tick_delay = self.diff_parameters[self.diff_image][3]
 
         self.all_sprites, self.tiles_group, self.artifact_group = None, None, None
-        self.player_group, self.bullet_group, self.enemy_group = None, None, None
-        self.buttons_group = None
+        self.player_group, self.enemy_group = None, None
+        self.bullets = BulletEngine(self)
+        # the player and enemies, which block the motion of each other
+        self.bodies = SpatialHash()
+        self.scenes, self.transition = [], None
+        # MENU_WAKEUP timer is started
+        self.menu_wakeup = False
+        self.built_scenes = {}
         self.game_map = None
         self.player = None
         self.room = None
         self.game_in_process = False
 
-        self.menu()
-
     def load_map(self, rooms_count):
         """
         Load a game map
@@ -361,129 +1505,56 @@ class Main:
         :param direction: direction of the room
         :return: None
         """
-        self.all_sprites, self.tiles_group = pygame.sprite.Group(), pygame.sprite.Group()
-        self.artifact_group, self.player_group = pygame.sprite.Group(), pygame.sprite.Group()
-        self.bullet_group, self.enemy_group = pygame.sprite.Group(), pygame.sprite.Group()
+        start = time.perf_counter()
+        self.bullets.clear()
         self.room = self.game_map.get_current_room()
+        self.tiles_group = self.room.tiles_group
+        self.artifact_group, self.enemy_group = self.room.artifact_group, self.room.enemy_group
         self.room.get_level(direction)
         self.player = self.room.player
+        self.game_map.keep_resident(self.room)
         self.game_map.update_doors()
+        self.register_bodies()
+        self.timer.add('room_load', time.perf_counter() - start)
+        self.prefetcher.request(self.game_map.neighbours())
 
     def menu(self):
         """
-        Show a menu screen and starts playing music in the menu
-        :return: None
+        Transition to the menu screen
+        :return: transition
         """
-        pygame.mouse.set_visible(1)
-        self.music.menu()
-        self.buttons_group = pygame.sprite.Group()
-        fon = pygame.transform.scale(load_image('fon_menu.png'), (self.WIDTH, self.HEIGHT))
-        self.screen.blit(fon, (0, 0))
-
-        Button(self.screen, self.buttons_group, 250, 150, "Buttons/Start_button.png",
-               "Buttons/Start_selected_button.png", False,
-               self.start_game)
-        Button(self.screen, self.buttons_group, 450, 375,
-               'Buttons/' + self.diff_stages[self.diff_image],
-               'Buttons/' + self.diff_stages[self.diff_image], False, None)
-        Button(self.screen, self.buttons_group, 250, 250, "Buttons/Setting_button.png",
-               "Buttons/Setting_selected_button.png", False, self.settings)
-        Button(self.screen, self.buttons_group, 250, 350, "Buttons/Autors_button.png",
-               "Buttons/Autors_selected_button.png", False, self.autors_show)
-        Button(self.screen, self.buttons_group, 250, 450, "Buttons/Exit_button.png",
-               "Buttons/Exit_selected_button.png", False, self.terminate)
-
-        while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.terminate()
-                if event.type == pygame.MOUSEMOTION:
-                    for button in self.buttons_group:
-                        button.check_mouse_pos(event.pos)
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    for elem in self.buttons_group:
-                        elem.check_click(event.pos)
-
-            self.buttons_group.draw(self.screen)
-            pygame.display.flip()
-            self.clock.tick(FPS)
+        return 'reset', self.get_scene(MenuScene)
 
     def congratulations(self):
-        pygame.mouse.set_visible(1)
-        fon = pygame.transform.scale(load_image('fon_menu.png'), (self.WIDTH, self.HEIGHT))
-        self.buttons_group = pygame.sprite.Group()
-        self.screen.blit(fon, (0, 0))
-        Button(self.screen, self.buttons_group, 250, 350, "Buttons/Start_button.png",
-               "Buttons/Start_selected_button.png", False,
-               self.start_game)
-        Button(self.screen, self.buttons_group, 350, 175, "Artifacts/Winner.png",
-               "Artifacts/Winner.png", False,
-               self.start_game)
-        Button(self.screen, self.buttons_group, 350, 425, "Buttons/Back_button.png",
-               "Buttons/Back_selected_button.png", False, self.menu)
-        while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.terminate()
-                if event.type == pygame.MOUSEMOTION:
-                    for button in self.buttons_group:
-                        button.check_mouse_pos(event.pos)
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    for elem in self.buttons_group:
-                        elem.check_click(event.pos)
-            self.music.check_stream('menu')
-            self.buttons_group.draw(self.screen)
-            pygame.display.flip()
-            self.clock.tick(FPS)
-
-    def settings(self):
         """
-        Show a settings screen
+        Show the congratulations screen after the current frame
         :return: None
         """
-        fon = pygame.transform.scale(load_image('fon_menu.png'), (self.WIDTH, self.HEIGHT))
-        self.buttons_group = pygame.sprite.Group()
-        self.screen.blit(fon, (0, 0))
-        # Volume
-        Button(self.screen, self.buttons_group, 215, 150, "Buttons/vol_button.png",
-               "Buttons/vol_selected_button.png", False, None)
-        Button(self.screen, self.buttons_group, 325, 150, "Buttons/settings_left_button.png",
-               "Buttons/settings_left_selected_button.png", False, self.change_settings_sound_low)
-        Button(self.screen, self.buttons_group, 575, 150, "Buttons/settings_right_button.png",
-               "Buttons/settings_right_selected_button.png", False, self.change_settings_sound_high)
-        Button(self.screen, self.buttons_group, 365, 150,
-               'Buttons/' + self.volume_stages[self.vol_set_image],
-               'Buttons/' + self.volume_stages[self.vol_set_image], False, None)
-        # Music
-        Button(self.screen, self.buttons_group, 215, 250, "Buttons/mus_button.png",
-               "Buttons/mus_selected_button.png", False, None)
-        Button(self.screen, self.buttons_group, 325, 250, "Buttons/settings_left_button.png",
-               "Buttons/settings_left_selected_button.png", False, self.change_settings_music_low)
-        Button(self.screen, self.buttons_group, 575, 250, "Buttons/settings_right_button.png",
-               "Buttons/settings_right_selected_button.png", False, self.change_settings_music_high)
-        Button(self.screen, self.buttons_group, 365, 250,
-               'Buttons/' + self.volume_stages[self.mus_set_image],
-               'Buttons/' + self.volume_stages[self.mus_set_image], False, None)
-        # Difficulty
-        Button(self.screen, self.buttons_group, 450, 375,
-               'Buttons/' + self.diff_stages[self.diff_image],
-               'Buttons/' + self.selected_diff_stages[self.diff_image], False,
-               self.change_settings_difficult)
-        if not self.game_in_process:
-            Button(self.screen, self.buttons_group, 275, 425, "Buttons/Back_button.png",
-                   "Buttons/Back_selected_button.png", False, self.menu)
-        else:
-            Button(self.screen, self.buttons_group, 250, 450, "Buttons/Continue_button.png",
-                   "Buttons/Continue_selected_button.png", False,
-                   self.pause)
+        self.transition = 'reset', self.get_scene(CongratulationsScene)
 
-        # TODO сделай так чтобы можно было вписать нужную папку или просто выбрать
-        #  между двумя папками (или папками которые находятся в Sounds)
+    def get_scene(self, scene_class):
+        """
+        Get the scene of the class. Every scene is created once and reused
+        :param scene_class: class of the scene
+        :return: scene
+        """
+        if scene_class not in self.built_scenes:
+            self.built_scenes[scene_class] = scene_class(self)
+        return self.built_scenes[scene_class]
 
-        # Прибавить\убавить звук в игре(без звука\тихо\норма\громко\бассбустед)
-        # Прибавить\убавить музыку
-        # Сложность (для детей\средний\для профи)
-        # Плейлист (имя папки с музыкой в папке Sounds, где все файлы в формате mp3, wav или ogg)
+    def menu_background(self):
+        """
+        Background of the menu screens scaled to the window
+        :return: surface
+        """
+        return load_image('fon_menu.png', scale=self.size)
+
+    def settings(self):
+        """
+        Transition to the settings screen
+        :return: transition
+        """
+        return 'push', self.get_scene(SettingsScene)
 
     # TODO переформатировать эти функции
     def change_settings_sound_high(self):
@@ -493,8 +1564,8 @@ class Main:
         """
         self.vol_set_image = (self.vol_set_image + 1) % len(self.volume_stages)
         self.music.volume_coeff = 1.5 * self.vol_set_image
-        self.settings()
         self.music.menu()
+        self.get_scene(SettingsScene).refresh()
 
     def change_settings_sound_low(self):
         # поправить
@@ -505,8 +1576,8 @@ class Main:
         self.vol_set_image = self.vol_set_image - 1 if self.vol_set_image >= 0 else len(
             self.volume_stages) - 1
         self.music.volume_coeff = 1.5 * self.vol_set_image
-        self.settings()
         self.music.menu()
+        self.get_scene(SettingsScene).refresh()
 
     def change_settings_music_high(self):
         """
@@ -515,7 +1586,7 @@ class Main:
         """
         self.mus_set_image = (self.mus_set_image + 1) % len(self.volume_stages)
         self.music.music_coeff = 1.5 * self.mus_set_image
-        self.settings()
+        self.get_scene(SettingsScene).refresh()
 
     def change_settings_music_low(self):
         # поправить
@@ -526,7 +1597,7 @@ class Main:
         self.mus_set_image = self.mus_set_image - 1 if self.mus_set_image >= 0 else len(
             self.volume_stages) - 1
         self.music.music_coeff = 1.5 * self.mus_set_image
-        self.settings()
+        self.get_scene(SettingsScene).refresh()
 
     def change_settings_difficult(self):
         """
@@ -534,38 +1605,60 @@ class Main:
         :return: None
         """
         self.diff_image = (self.diff_image + 1) % len(self.diff_stages)
-        self.settings()
+        self.get_scene(SettingsScene).refresh()
 
-    def start_game(self):
+    def new_game(self):
         """
-        This function start the game process
+        Prepare the new game: player parameters, map and the first room
         :return: None
         """
         self.game_in_process = True
-        pygame.mouse.set_visible(0)
-        self.music.game()
+        self.transition = None
+        if not self.headless:
+            self.music.game()
         self.player_parameters = [5, 1, 3.5, 5, 21, self.diff_parameters[self.diff_image][0]]
+        self.all_sprites, self.player_group = pygame.sprite.Group(), pygame.sprite.Group()
+        self.player = None
+        self.bullets.clear()
         self.load_map(5)
         self.load_room(0)
-        self.main_cycle()
+        if 'PUNKS_PROFILE_FRAMES' in os.environ:
+            self.profiler.request()
+
+    def start_game(self):
+        """
+        This function start the game process
+        :return: transition to the game screen
+        """
+        self.new_game()
+        return 'reset', self.get_scene(GameScene)
+
+    def simulate(self, frames):
+        """
+        Run the new game without frame limiter (headless mode). The simulation stops on the game
+        over or the victory, pause is ignored
+        :param frames: how many frames need to simulate
+        :return: dict with simulated frames per second and mean time of every phase
+        """
+        self.new_game()
+        self.timer.reset()
+        frame = 0
+        start = time.perf_counter()
+        while frame < frames:
+            transition = self.run_frame()
+            frame += 1
+            if transition is not None and transition[0] != 'push':
+                break
+        seconds = time.perf_counter() - start
+        return {'frames': frame, 'seconds': seconds, 'fps': frame / seconds if seconds else 0,
+                'phases': self.timer.means()}
 
     def autors_show(self):
         """
-        Function to show a authors screen
-        :return: None
+        Transition to the authors screen
+        :return: transition
         """
-        fon = pygame.transform.scale(load_image('fon_menu.png'), (self.WIDTH, self.HEIGHT))
-        text = "Урвачев Роман и Зотова Екатерина"
-        self.buttons_group = pygame.sprite.Group()
-        self.screen.blit(fon, (0, 0))
-        font = pygame.font.Font(None, 30)
-        text_rendered = font.render(text, 1, pygame.Color('black'))
-        self.screen.blit(text_rendered, (250, 250))
-        Button(self.screen, self.buttons_group, 250, 300, "Buttons/Start_button.png",
-               "Buttons/Start_selected_button.png", False,
-               self.start_game)
-        Button(self.screen, self.buttons_group, 275, 425, "Buttons/Back_button.png",
-               "Buttons/Back_selected_button.png", False, self.menu)
+        return 'push', self.get_scene(AuthorsScene)
 
     def show_stats(self):
         """
@@ -590,227 +1683,588 @@ class Main:
             intro_rect.x = 50
             text_coord += intro_rect.height
             self.screen.blit(string_rendered, intro_rect)
+            self.renderer.add_rect(intro_rect)
+
+    def show_timings(self):
+        """
+        Function to show timings of the frame phases during the game (F3).
+        The text is rendered again only every TIMINGS_REFRESH frames
+        :return: None
+        """
+        if not self.timings_lines or self.timer.frames % TIMINGS_REFRESH == 0:
+            if self.timings_font is None:
+                self.timings_font = pygame.font.Font(None, 22)
+            rows = [('ms', 'avg', 'p95', 'p99')]
+            for phase, values in self.timer.rolling().items():
+                rows.append((phase,) + tuple('%.2f' % value for value in values))
+            self.timings_lines = []
+            for y, row in enumerate(rows):
+                for x, text in enumerate(row):
+                    string_rendered = self.timings_font.render(text, 1, pygame.Color('black'))
+                    timings_rect = string_rendered.get_rect()
+                    timings_rect.top = 65 + y * 17
+                    if x == 0:
+                        timings_rect.x = 375
+                    else:
+                        timings_rect.right = 452 + x * 47
+                    self.timings_lines.append((string_rendered, timings_rect))
+        area = pygame.Rect(370, 60, 230, 10 + 17 * len(self.timer.windows) + 17)
+        pygame.draw.rect(self.screen, pygame.Color('white'), area)
+        for string_rendered, timings_rect in self.timings_lines:
+            self.screen.blit(string_rendered, timings_rect)
+        self.renderer.add_rect(area)
 
     def stop(self):
-        return True
+        """
+        Close the current screen (Continue and Back buttons)
+        :return: transition
+        """
+        return 'pop',
 
     def pause(self):
-        pygame.mouse.set_visible(1)
-        self.buttons_group = pygame.sprite.Group()
-        fon = pygame.transform.scale(load_image('fon_menu.png'), (self.WIDTH, self.HEIGHT))
-        self.screen.blit(fon, (0, 0))
-
-        Button(self.screen, self.buttons_group, 450, 375,
-               'Buttons/' + self.diff_stages[self.diff_image],
-               'Buttons/' + self.diff_stages[self.diff_image], False, None)
-        Button(self.screen, self.buttons_group, 250, 150, "Buttons/Continue_button.png",
-               "Buttons/Continue_selected_button.png", False, self.stop)
-        Button(self.screen, self.buttons_group, 250, 250, "Buttons/Setting_button.png",
-               "Buttons/Setting_selected_button.png", False, self.settings)
-        Button(self.screen, self.buttons_group, 250, 350, "Buttons/Exit_button.png",
-               "Buttons/Exit_selected_button.png", False, self.terminate)
-        running = True
-        while running:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.terminate()
-                if event.type == pygame.MOUSEMOTION:
-                    for button in self.buttons_group:
-                        button.check_mouse_pos(event.pos)
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    for elem in self.buttons_group:
-                        if elem.check_click(event.pos):
-                            running = False
-            keys = pygame.key.get_pressed()
-            if keys[pygame.K_ESCAPE] == 1:
-                running = False
-            self.music.check_stream('game')
-            self.buttons_group.draw(self.screen)
-            pygame.display.flip()
-            self.clock.tick(FPS)
+        """
+        Transition to the pause screen
+        :return: transition
+        """
+        return 'push', self.get_scene(PauseScene)
 
     def game_over(self):
         """
-        Function to show the endgame screen
+        Show the endgame screen after the current frame
         :return: None
         """
-        pygame.mouse.set_visible(1)
-        self.buttons_group = pygame.sprite.Group()
-        text = "Гамовер"
-        fon = pygame.transform.scale(load_image('fon_menu.png'), (self.WIDTH, self.HEIGHT))
-        self.screen.blit(fon, (0, 0))
-        font = pygame.font.Font(None, 100)
-        text_rendered = font.render(text, 1, pygame.Color('black'))
-        self.screen.blit(text_rendered, (250, 175))
+        self.transition = 'replace', self.get_scene(GameOverScene)
 
-        Button(self.screen, self.buttons_group, 250, 250, "Buttons/Continue_button.png",
-               "Buttons/Continue_selected_button.png", False,
-               self.start_game)
-        Button(self.screen, self.buttons_group, 250, 350, "Buttons/Setting_button.png",
-               "Buttons/Setting_selected_button.png", False, self.settings)
-        Button(self.screen, self.buttons_group, 250, 450, "Buttons/Exit_button.png",
-               "Buttons/Exit_selected_button.png", False, self.terminate)
+    def terminate(self):
+        """
+        Close the game window
+        :return: None
+        """
+        if isinstance(self.input, InputRecorder):
+            self.input.save()
+        if self.timings_csv:
+            self.timer.save_csv(self.timings_csv)
+        self.profiler.save()
+        pygame.quit()
+        sys.exit()
 
-        while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.terminate()
-                if event.type == pygame.MOUSEMOTION:
-                    for button in self.buttons_group:
-                        button.check_mouse_pos(event.pos)
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    for elem in self.buttons_group:
-                        elem.check_click(event.pos)
-            self.music.check_stream('menu')
-            self.buttons_group.draw(self.screen)
-            pygame.display.flip()
+    def reset(self):
+        """
+        reinitialization of class Main
+        :return: None
+        """
+        self.__init__()
+
+    def draw_map(self, numb):
+        if numb == 3:
+            self.renderer.add_rect((660, 50, 120, numb * 40))
+            room_x, room_y = self.game_map.current_x, self.game_map.current_y - 1
+            for y in range(numb):
+                count = 0
+                for x in range(-1, 2):
+                    room = self.game_map.map[room_y][room_x + x]
+                    if room:
+                        pygame.draw.rect(self.screen, pygame.Color('black'), (
+                            x * 40 + 700, y * 40 + 50,
+                            40, 40), 1)
+                    if room is not None and room.enemies_init:
+                        pygame.draw.rect(self.screen, pygame.Color('black'), (
+                            x * 40 + 700, y * 40 + 50,
+                            40, 40), 0)
+                    if room == self.game_map.map[self.game_map.current_y][self.game_map.current_x] \
+                            and room.player:
+                        pygame.draw.rect(self.screen, pygame.Color('red'), (
+                            x * 40 + 700, y * 40 + 50,
+                            40, 40), 0)
+                    count += 1
+                room_y += 1
+        else:
+            self.renderer.add_rect((610, 50, 120, numb * 40))
+            room_x, room_y = self.game_map.current_x, self.game_map.current_y - 2
+            for y in range(numb):
+                count = 0
+                for x in range(-1, 2):
+                    room = self.game_map.map[room_y][room_x + x]
+                    if room:
+                        pygame.draw.rect(self.screen, pygame.Color('black'), (
+                            x * 40 + 650, y * 40 + 50,
+                            40, 40), 1)
+                    if room == self.game_map.map[self.game_map.current_y][self.game_map.current_x]:
+                        pygame.draw.rect(self.screen, pygame.Color('red'), (
+                            x * 40 + 650, y * 40 + 50,
+                            40, 40), 0)
+                    if room is not None and (room.enemies_init or room.artifacts_init):
+                        pygame.draw.rect(self.screen, pygame.Color('black'), (
+                            x * 40 + 650, y * 40 + 50,
+                            40, 40), 0)
+                    count += 1
+                room_y += 1
+
+    def run(self, scene=None):
+        """
+        The only cycle of the game. It updates the top scene of the stack and applies the
+        transition which the scene returns, so the call stack does not grow between the screens
+        :param scene: the first scene (default - menu)
+        :return: None
+        """
+        self.change_scene(('reset', scene or self.get_scene(MenuScene)))
+        while self.scenes:
+            transition = self.scenes[-1].update()
+            if transition is not None:
+                self.change_scene(transition)
             self.clock.tick(FPS)
 
-    def terminate(self):
+    def change_scene(self, transition):
+        """
+        Apply the transition to the stack of scenes
+        :param transition: ('push', scene), ('pop',), ('replace', scene) or ('reset', scene)
+        :return: None
+        """
+        action = transition[0]
+        if action == 'push':
+            self.scenes.append(transition[1])
+        elif action == 'pop':
+            self.scenes.pop()
+        elif action == 'replace':
+            self.scenes[-1] = transition[1]
+        elif action == 'reset':
+            self.scenes = [transition[1]]
+        if self.scenes:
+            self.scenes[-1].enter()
+
+    def run_frame(self):
+        """
+        One frame of the game, profiled if the profiling was requested (F9)
+        :return: transition or None
+        """
+        if self.profiler.frames_left:
+            return self.profiler.run(self)
+        return self.step()
+
+    def register_bodies(self):
+        """
+        Register the player and enemies of the room in the spatial hash (once per frame, then
+        they update their cells when they move)
+        :return: None
+        """
+        self.bodies.clear()
+        self.bodies.add(self.player)
+        for enemy in self.enemy_group:
+            self.bodies.add(enemy)
+
+    def step(self):
+        """
+        One frame of the game
+        :return: transition (pause, game over or victory) or None
+        """
+        self.timer.start()
+        self.register_bodies()
+        self.renderer.draw(self.room, (self.enemy_group, self.artifact_group,
+                                       self.bullets, self.player_group))
+        self.timer.mark('draw')
+
+        events, keys = self.input.poll()
+        for event in events:
+            if event.type == pygame.QUIT:
+                self.terminate()
+            if event.type == pygame.KEYDOWN:
+                self.counter = 0
+                if event.key == pygame.K_F3:
+                    self.timings_shown = not self.timings_shown
+                elif event.key == pygame.K_F9:
+                    self.profiler.request()
+                elif event.key == pygame.K_ESCAPE and not self.headless:
+                    self.transition = self.pause()
+            if event.type == pygame.KEYUP:
+                if (event.key == pygame.K_w or event.key == pygame.K_s or
+                        event.key == pygame.K_a or event.key == pygame.K_d or
+                        event.key == pygame.K_UP or event.key == pygame.K_RIGHT or
+                        event.key == pygame.K_DOWN or event.key == pygame.K_LEFT):
+                    self.player.cur = 0
+                    self.player.change_image(self.player.images, self.player.direction)
+                    self.player.change_direction(-1)
+        self.timer.mark('events')
+        if keys[pygame.K_LSHIFT] == 1:
+            self.draw_map(5)
+        else:
+            self.draw_map(3)
+        self.timer.mark('draw_map')
+        if keys[pygame.K_r] == 1:
+            self.new_game()
+            return None
+        if keys[pygame.K_w] == 1:
+            self.player.move(0)
+        if keys[pygame.K_s] == 1:
+            self.player.move(2)
+        if keys[pygame.K_a] == 1:
+            self.player.move(3)
+        if keys[pygame.K_d] == 1:
+            self.player.move(1)
+        if keys[pygame.K_UP]:
+            if self.counter % self.player.player_parameters[4] == 0:
+                self.player.shoot(0)
+        elif keys[pygame.K_RIGHT]:
+            if self.counter % self.player.player_parameters[4] == 0:
+                self.player.shoot(1)
+        elif keys[pygame.K_DOWN]:
+            if self.counter % self.player.player_parameters[4] == 0:
+                self.player.shoot(2)
+        elif keys[pygame.K_LEFT]:
+            if self.counter % self.player.player_parameters[4] == 0:
+                self.player.shoot(3)
+        elif keys[pygame.K_TAB] == 1:
+            self.show_stats()
+        self.timer.mark('player_move')
+        if self.timings_shown:
+            self.show_timings()
+            self.timer.mark('overlay')
+
+        self.bullets.move(self.room)
+        self.timer.mark('bullets')
+
+        for elem in self.player_group:
+            elem.render()
+            elem.check_collision()
+        self.timer.mark('player')
+
+        for elem in self.artifact_group:
+            elem.check_collision()
+        self.timer.mark('artifacts')
+
+        self.ai.run(self.enemy_group)
+        self.timer.mark('enemies')
+
+        door = self.game_map.check_door()
+        if door[0]:
+            self.load_room(door[1])
+        self.timer.mark('doors')
+
+        if not self.headless:
+            self.music.check_stream('game')
+        self.music.flush()
+        self.player.render()
+        self.timer.mark('audio')
+        self.renderer.update()
+        self.timer.mark('flip')
+        self.prefetcher.idle()
+        self.timer.mark('prefetch')
+        self.counter += 1
+        transition, self.transition = self.transition, None
+        return transition
+
+
+# folder with the level files and the file with the baked levels (made by bake_assets.py)
+LEVELS_FOLDER = 'levels'
+LEVEL_PACK = os.environ.get('PUNKS_LEVEL_PACK', 'levels.pack')
+LEVEL_PACK_VERSION = 1
+# sign of the level map: tile type, block player, block bullets, damage player
+LEVEL_TILES = {
+    '.': ('empty', False, False, False),
+    '@': ('empty', False, False, False),
+    'E': ('empty', False, False, False),
+    'B': ('empty', False, False, False),
+    'A': ('empty', False, False, False),
+    '#': ('wall', True, True, False),
+    'R': ('rock', True, True, False),
+    '0': ('hole', True, False, True),
+    '^': ('door_up', False, True, False),
+    '>': ('door_right', False, True, False),
+    'v': ('door_down', False, True, False),
+    '<': ('door_left', False, True, False)}
+# signs of the cells where enemies can not walk
+LEVEL_BLOCKED = '#0^<>vR'
+# sign of the door: direction
+LEVEL_DOORS = {'^': 0, '>': 1, 'v': 2, '<': 3}
+# direction of the door: shift of the player who comes into the room through this door
+LEVEL_ENTRANCES = {0: (0, 1), 1: (-1, 0), 2: (0, -1), 3: (1, 0)}
+
+
+class LevelTemplate:
+    def __init__(self, name, exits, rows):
+        """
+        initialization of class LevelTemplate. Template is the compiled level file: it is made once
+        and shared by all rooms of the level, so it must not be changed
+        :param name: name of the level
+        :param exits: directions of the room exits
+        :param rows: lines of the level map (all of the same width)
+        """
+        self.name = name
+        self.exits = tuple(exits)
+        self.rows = tuple(rows)
+        self.width, self.height = len(self.rows[0]), len(self.rows)
+        # 0 - enemies can not walk here, -1 - they can
+        self.room_map = tuple(tuple(0 if sign in LEVEL_BLOCKED else -1 for sign in row)
+                              for row in self.rows)
+        tiles, doors, players, spawns = [], {}, [], []
+        for y, row in enumerate(self.rows):
+            for x, sign in enumerate(row):
+                if sign in LEVEL_TILES:
+                    tiles.append((x, y) + LEVEL_TILES[sign])
+                if sign in LEVEL_DOORS:
+                    doors[LEVEL_DOORS[sign]] = (x, y)
+                if sign == '@':
+                    players.append((x, y))
+                elif sign in 'EBA':
+                    spawns.append((sign, x, y))
+        self.tiles, self.doors = tuple(tiles), doors
+        # enemies (E), bosses (B) and artifacts (A) in the order of the map
+        self.players, self.spawns = tuple(players), tuple(spawns)
+        self.reach = self.bullet_reach()
+
+    def bullet_reach(self):
+        """
+        Find how far a bullet flies from every cell before a cell which blocks bullets (the map
+        edge blocks them too)
+        :return: for the directions 0 - up, 1 - right, 2 - down, 3 - left the tables
+        reach[y][x]: the last row (up, down) or column (right, left) which the bullet reaches
+        """
+        blocked = [[False] * self.width for _ in range(self.height)]
+        for x, y, _, _, block_bullets, _ in self.tiles:
+            blocked[y][x] = block_bullets
+        up, down = [[0] * self.width for _ in range(self.height)], \
+            [[0] * self.width for _ in range(self.height)]
+        for x in range(self.width):
+            last = -1
+            for y in range(self.height):
+                if blocked[y][x]:
+                    last = y
+                up[y][x] = last + 1
+            last = self.height
+            for y in range(self.height - 1, -1, -1):
+                if blocked[y][x]:
+                    last = y
+                down[y][x] = last - 1
+        right, left = [], []
+        for row in blocked:
+            left.append([0] * self.width)
+            right.append([0] * self.width)
+            last = -1
+            for x in range(self.width):
+                if row[x]:
+                    last = x
+                left[-1][x] = last + 1
+            last = self.width
+            for x in range(self.width - 1, -1, -1):
+                if row[x]:
+                    last = x
+                right[-1][x] = last - 1
+        return tuple(tuple(map(tuple, table)) for table in (up, right, down, left))
+
+    def clear_shot(self, direction, shot, target):
+        """
+        Check that the bullet flies to the target without hitting a cell which blocks bullets
+        :param direction: direction of the shot
+        :param shot: cells (left, top, right, bottom) which the bullet overlaps when it is shot
+        :param target: cells (left, top, right, bottom) which the target overlaps
+        :return: True if the bullet reaches the target
+        """
+        left, top, right, bottom = shot
+        if not (0 <= left <= right < self.width and 0 <= top <= bottom < self.height):
+            return False
+        reach = self.reach[direction]
+        if direction == 0:
+            return max(reach[top][left], reach[top][right]) <= target[3]
+        if direction == 1:
+            return min(reach[top][right], reach[bottom][right]) >= target[0]
+        if direction == 2:
+            return min(reach[bottom][left], reach[bottom][right]) >= target[1]
+        return max(reach[top][left], reach[bottom][left]) <= target[2]
+
+    @classmethod
+    def load(cls, name, folder=LEVELS_FOLDER):
+        """
+        Compile the level file. The first line of the file is the exits, the others are the map
+        :param name: name of the level (file name without .txt)
+        :param folder: folder with the level files
+        :return: LevelTemplate
+        """
+        with open(os.path.join(folder, name + '.txt'), 'r') as map_file:
+            exits = list(map(int, map_file.readline().split()))
+            level_map = [line.strip() for line in map_file]
+        max_width = max(map(len, level_map))
+        return cls(name, exits, [line.ljust(max_width, '.') for line in level_map])
+
+
+class LevelLibrary:
+    def __init__(self, folder=LEVELS_FOLDER, pack=LEVEL_PACK):
+        """
+        initialization of class LevelLibrary. It compiles all levels once, from the level pack
+        or from the level files (when there is no pack or a file is changed after baking)
+        :param folder: folder with the level files
+        :param pack: file with the baked levels
+        """
+        self.folder, self.pack = folder, pack
+        self.templates = None
+        self.from_pack, self.from_files = 0, 0
+
+    def read_pack(self):
+        """
+        Read the level pack
+        :return: dict name: entry (empty if there is no pack)
+        """
+        if not self.pack or not os.path.exists(self.pack):
+            return {}
+        try:
+            with open(self.pack, 'r') as pack_file:
+                pack = json.load(pack_file)
+            if pack['version'] != LEVEL_PACK_VERSION:
+                raise ValueError('неизвестная версия')
+        except (OSError, ValueError, KeyError) as error:
+            print('Не могу открыть', self.pack, '-', error)
+            return {}
+        return pack['levels']
+
+    def load(self):
+        """
+        Compile all levels
+        :return: None
+        """
+        self.templates = {}
+        packed = self.read_pack()
+        names = set(packed)
+        if os.path.isdir(self.folder):
+            names.update(filename[:-4] for filename in os.listdir(self.folder)
+                         if filename.endswith('.txt'))
+        for name in sorted(names):
+            entry = packed.get(name)
+            path = os.path.join(self.folder, name + '.txt')
+            if entry is not None and os.path.exists(path):
+                stat = os.stat(path)
+                if stat.st_size != entry['bytes'] or stat.st_mtime_ns != entry['mtime']:
+                    entry = None
+            if entry is not None:
+                self.templates[name] = LevelTemplate(name, entry['exits'], entry['rows'])
+                self.from_pack += 1
+            else:
+                self.templates[name] = LevelTemplate.load(name, self.folder)
+                self.from_files += 1
+
+    def get(self, name):
+        """
+        Get the template of the level
+        :param name: name of the level
+        :return: LevelTemplate
+        """
+        if self.templates is None:
+            self.load()
+        return self.templates[name]
+
+    def stats(self):
+        """
+        Statistics of the library
+        :return: dict with count of levels loaded from the pack and from the files
+        """
+        return {'from_pack': self.from_pack, 'from_files': self.from_files}
+
+
+# how many rooms keep their tiles and background after the player leaves them
+ROOMS_RESIDENT = 6
+# plan the rooms behind the exits of the current room in a separate thread (grids and tiles),
+# their backgrounds are drawn by the game between the frames
+ROOM_PREFETCH = True
+
+
+class RoomPrefetcher:
+    def __init__(self, enabled=ROOM_PREFETCH):
+        """
+        initialization of class RoomPrefetcher. Its thread plans the rooms where the player can
+        go (collision grids and tiles of the background), the game draws one planned background
+        after every frame and only takes them on the transition. pygame surfaces are not
+        thread-safe, so the thread doesn't touch pygame
+        :param enabled: use the thread (else every room is built on the transition)
+        """
+        self.enabled = enabled
+        # the dicts of the rooms are changed only under this lock
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = None
+        self.wanted, self.planned, self.prepared = set(), {}, {}
+        self.hits, self.drawn, self.misses = 0, 0, 0
+
+    def request(self, rooms):
         """
-        Close the game window
+        Prepare the rooms in the thread. Prepared rooms which are not requested now are forgotten
+        :param rooms: rooms where the player can go from the current room
         :return: None
         """
-        pygame.quit()
-        sys.exit()
+        if not self.enabled:
+            return
+        with self.lock:
+            self.wanted = set(rooms)
+            self.planned = {room: plan for room, plan in self.planned.items()
+                            if room in self.wanted}
+            self.prepared = {room: layers for room, layers in self.prepared.items()
+                             if room in self.wanted}
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, name='room-prefetch', daemon=True)
+            self.thread.start()
+        for room in rooms:
+            self.queue.put(room)
+
+    def work(self):
+        """
+        Thread of the prefetcher: plan the requested rooms one by one
+        :return: None
+        """
+        while True:
+            room = self.queue.get()
+            try:
+                with self.lock:
+                    if room in self.wanted and room not in self.planned \
+                            and room not in self.prepared:
+                        self.planned[room] = room.plan_layers()
+            finally:
+                self.queue.task_done()
 
-    def reset(self):
+    def wait(self):
         """
-        reinitialization of class Main
+        Wait until all requested rooms are planned
         :return: None
         """
-        self.__init__()
+        self.queue.join()
 
-    def draw_map(self, numb):
-        if numb == 3:
-            room_x, room_y = self.game_map.current_x, self.game_map.current_y - 1
-            for y in range(numb):
-                count = 0
-                for x in range(-1, 2):
-                    room = self.game_map.map[room_y][room_x + x]
-                    if room:
-                        pygame.draw.rect(self.screen, pygame.Color('black'), (
-                            x * 40 + 700, y * 40 + 50,
-                            40, 40), 1)
-                    if room is not None and room.enemies_init:
-                        pygame.draw.rect(self.screen, pygame.Color('black'), (
-                            x * 40 + 700, y * 40 + 50,
-                            40, 40), 0)
-                    if room == self.game_map.map[self.game_map.current_y][self.game_map.current_x] \
-                            and room.player:
-                        pygame.draw.rect(self.screen, pygame.Color('red'), (
-                            x * 40 + 700, y * 40 + 50,
-                            40, 40), 0)
-                    count += 1
-                room_y += 1
-        else:
-            room_x, room_y = self.game_map.current_x, self.game_map.current_y - 2
-            for y in range(numb):
-                count = 0
-                for x in range(-1, 2):
-                    room = self.game_map.map[room_y][room_x + x]
-                    if room:
-                        pygame.draw.rect(self.screen, pygame.Color('black'), (
-                            x * 40 + 650, y * 40 + 50,
-                            40, 40), 1)
-                    if room == self.game_map.map[self.game_map.current_y][self.game_map.current_x]:
-                        pygame.draw.rect(self.screen, pygame.Color('red'), (
-                            x * 40 + 650, y * 40 + 50,
-                            40, 40), 0)
-                    if room is not None and (room.enemies_init or room.artifacts_init):
-                        pygame.draw.rect(self.screen, pygame.Color('black'), (
-                            x * 40 + 650, y * 40 + 50,
-                            40, 40), 0)
-                    count += 1
-                room_y += 1
+    def idle(self):
+        """
+        Draw the background of one planned room. It is called by the game after the frame
+        :return: True if a background was drawn
+        """
+        with self.lock:
+            if not self.planned:
+                return False
+            room, plan = self.planned.popitem()
+        layers = room.draw_layers(plan)
+        with self.lock:
+            if room in self.wanted:
+                self.prepared[room] = layers
+        return True
 
-    def main_cycle(self):
-        """
-        The main game cycle
-        :return: None
-        """
-        while self.running:
-            self.screen.fill((0, 0, 0))
-            self.tiles_group.draw(self.screen)
-            self.enemy_group.draw(self.screen)
-            self.artifact_group.draw(self.screen)
-            self.bullet_group.draw(self.screen)
-            self.player_group.draw(self.screen)
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.terminate()
-                if event.type == pygame.KEYDOWN:
-                    self.counter = 0
-                if event.type == pygame.KEYUP:
-                    if (event.key == pygame.K_w or event.key == pygame.K_s or
-                            event.key == pygame.K_a or event.key == pygame.K_d or
-                            event.key == pygame.K_UP or event.key == pygame.K_RIGHT or
-                            event.key == pygame.K_DOWN or event.key == pygame.K_LEFT):
-                        self.player.cur = 0
-                        self.player.change_image(self.player.images, self.player.direction)
-                        self.player.change_direction(-1)
-            keys = pygame.key.get_pressed()
-            if keys[pygame.K_ESCAPE] == 1:
-                self.pause()
-            if keys[pygame.K_LSHIFT] == 1:
-                self.draw_map(5)
-            else:
-                self.draw_map(3)
-            if keys[pygame.K_r] == 1:
-                self.start_game()
-            if keys[pygame.K_w] == 1:
-                self.player.move(0)
-            if keys[pygame.K_s] == 1:
-                self.player.move(2)
-            if keys[pygame.K_a] == 1:
-                self.player.move(3)
-            if keys[pygame.K_d] == 1:
-                self.player.move(1)
-            if keys[pygame.K_UP]:
-                if self.counter % self.player.player_parameters[4] == 0:
-                    self.player.shoot(0)
-            elif keys[pygame.K_RIGHT]:
-                if self.counter % self.player.player_parameters[4] == 0:
-                    self.player.shoot(1)
-            elif keys[pygame.K_DOWN]:
-                if self.counter % self.player.player_parameters[4] == 0:
-                    self.player.shoot(2)
-            elif keys[pygame.K_LEFT]:
-                if self.counter % self.player.player_parameters[4] == 0:
-                    self.player.shoot(3)
-            elif keys[pygame.K_TAB] == 1:
-                self.show_stats()
-
-            for elem in self.bullet_group:
-                elem.render()
-                elem.move()
-
-            for elem in self.player_group:
-                elem.render()
-                elem.check_collision()
-
-            for elem in self.artifact_group:
-                elem.check_collision()
-
-            for elem in self.enemy_group:
-                elem.move()
-                elem.render()
-                elem.check_player_coords()
-                elem.check_collision()
-
-            door = self.game_map.check_door()
-            if door[0]:
-                self.load_room(door[1])
-
-            for elem in self.bullet_group:
-                elem.render()
+    def take(self, room):
+        """
+        Get the prepared background and grids of the room. If the room is only planned, its
+        background is drawn now, if it is not planned yet, it is built now
+        :param room: room which the player enters
+        :return: background, grid which blocks player, grid which blocks bullets
+        """
+        with self.lock:
+            self.wanted.discard(room)
+            layers = self.prepared.pop(room, None)
+            plan = self.planned.pop(room, None)
+        if layers is not None:
+            self.hits += 1
+            return layers
+        if plan is not None:
+            self.drawn += 1
+            return room.draw_layers(plan)
+        self.misses += 1
+        return room.build_layers()
 
-            self.music.check_stream('game')
-            self.player.render()
-            pygame.display.flip()
-            self.clock.tick(FPS)
-            self.counter += 1
+    def stats(self):
+        """
+        Statistics of the prefetcher
+        :return: dict with count of prepared, only planned and not prepared rooms on the
+                 transitions
+        """
+        return {'prefetched': self.hits, 'planned': self.drawn, 'built': self.misses}
 
 
 class Room:
@@ -822,167 +2276,253 @@ class Room:
         """
         self.main = main
         self.enemies_init, self.artifacts_init = True, True
-        self.filename, self.exits, self.enemies, self.room_map = filename, [], 0, []
+        self.filename, self.enemies = filename, 0
+        self.template = main.levels.get(filename)
+        self.exits, self.room_map = self.template.exits, self.template.room_map
         self.artifacts, self.boss = 0, False
         self.door_up, self.door_right, self.door_down, self.door_left = None, None, None, None
-        self.load_level(self.filename + ".txt")
+        self.flow_field, self.flow_target = None, None
+        self.block_player_grid, self.block_bullets_grid = None, None
+        self.background, self.prize = None, None
         self.player, self.width, self.height = None, None, None
+        # sprites of the room stay in the room when the player leaves it. Only doors are tile
+        # sprites, other tiles are drawn on the background
+        self.tiles_group, self.enemy_group = pygame.sprite.Group(), pygame.sprite.Group()
+        self.artifact_group = pygame.sprite.Group()
 
     def get_level(self, direction):
         """
-        Selection of a room with the necessary direction
+        Selection of a room with the necessary direction. The room is built on the first visit
+        (and after unloading), on the next visits only the player is placed
         :param direction: the direction needed
         :return: None
         """
-        self.player, self.width, self.height = self.generate_level(
-            self.load_level(self.filename + ".txt"), direction)
+        if self.background is None:
+            self.generate_level(self.template)
+        self.player = self.place_player(self.template, direction)
+        self.width, self.height = self.template.width, self.template.height
 
-    def load_level(self, filename):
+    def place_player(self, template, player_direction):
         """
-        Reform text file in map. Map type is list of lists where all objects are just sign
-        :param filename: the name of text file from what the level map load
-        :return: list of lists
+        Put the player near the door through which he comes in (in the start room - on its
+        place). The player is created only at the beginning of the game
+        :param template: LevelTemplate of the room
+        :param player_direction: direction of player
+        :return: player
+        """
+        main = self.main
+        if self.filename == "start":
+            positions = template.players
+        elif player_direction in template.doors:
+            x, y = template.doors[player_direction]
+            delta_x, delta_y = LEVEL_ENTRANCES[player_direction]
+            positions = [(x + delta_x, y + delta_y)]
+        else:
+            return main.player
+        for x, y in positions:
+            if main.player is None:
+                main.player = Player(self, x, y, main.assets.get(main.player_animation),
+                                     main.assets.get(main.player_shoot_animation), -1, main,
+                                     main.player_parameters)
+            else:
+                main.player.enter(self, x, y)
+        return main.player
+
+    def generate_level(self, template):
         """
-        filename = "Levels/" + filename
-        # читаем уровень, убирая символы перевода строки
-        with open(filename, 'r') as mapFile:
-            for line in mapFile:
-                self.exits = list(map(int, line.split()))
-                break
-            level_map = [line.strip() for line in mapFile]
-        max_width = max(map(len, level_map))
-        for elem in list(map(lambda x: x.ljust(max_width, '.'), level_map)):
-            self.room_map.append(
-                list(map(lambda x: 0 if x in ["#", "0", "^", "<", ">", "v", "R"] else -1, elem)))
+        Tranform the level template into classes
+        :param template: LevelTemplate of the room
+        :return: None
+        """
+        main = self.main
+        self.background, self.block_player_grid, self.block_bullets_grid = \
+            main.prefetcher.take(self)
+        doors = []
+        for direction in range(4):
+            if direction in template.doors:
+                x, y = template.doors[direction]
+                tile_type, block_player, block_bullets, damage_player = LEVEL_TILES[
+                    template.rows[y][x]]
+                doors.append(Tile(tile_type, x, y, block_player, block_bullets, damage_player,
+                                  main))
+            else:
+                doors.append(None)
+        self.door_up, self.door_right, self.door_down, self.door_left = doors
+        for sign, x, y in template.spawns:
+            if sign == 'E' and self.enemies_init:
+                Enemy(self, x, y, main.assets.get('Cop'), main.assets.get('Cop_shoot'), -1, main)
+                self.enemies += 1
+            elif sign == 'B' and self.enemies_init:
+                Boss(self, x, y, main.assets.get('boss_r'), main.assets.get('boss_shoot'), -1,
+                     main)
+                self.enemies += 1
+                self.boss = True
+            elif sign == 'A' and self.artifacts_init:
+                self.artifacts += 1
+                Artifact(x, y, main)
+        self.artifacts_init, self.enemies_init = False, False
 
-        return list(map(lambda x: x.ljust(max_width, '.'), level_map))
+    def plan_layers(self):
+        """
+        Build the grids of cells which block the player and bullets and the list of the static
+        tiles of the background. Doors are not drawn, because their images change when they
+        open or close. The room, the game and pygame are not touched, so it can run in the
+        prefetch thread
+        :return: tiles of the background (tile type, position), grid which blocks player,
+                 grid which blocks bullets
+        """
+        main, template = self.main, self.template
+        doors = set(template.doors.values())
+        tiles = []
+        block_player_grid = [[False] * template.width for _ in range(template.height)]
+        block_bullets_grid = [[False] * template.width for _ in range(template.height)]
+        for x, y, tile_type, block_player, block_bullets, _ in template.tiles:
+            block_player_grid[y][x], block_bullets_grid[y][x] = block_player, block_bullets
+            if (x, y) not in doors:
+                tiles.append((tile_type, (main.tile_width * x, main.tile_height * y)))
+        return tiles, block_player_grid, block_bullets_grid
 
-    def generate_level(self, level, player_direction):
+    def draw_layers(self, plan):
         """
-        Tranform signs in level into classes
-        :param level: level map
-        :param player_direction: direction of player
-        :return: player and his location in the rooms on the map
-        """
-        new_player, x, y = None, None, None
-        for y in range(len(level)):
-            for x in range(len(level[y])):
-                if level[y][x] == '.':
-                    Tile('empty', x, y, False, False, False, self.main)
-                elif level[y][x] == '#':
-                    Tile('wall', x, y, True, True, False, self.main)
-                elif level[y][x] == '@':
-                    if self.filename == "start":
-                        new_player = Player(self, x, y, self.main.player_image_file,
-                                            self.main.player_shoot_file, -1,
-                                            self.main, self.main.player_parameters)
-                    Tile('empty', x, y, False, False, False, self.main)
-                elif level[y][x] == 'E':
-                    if self.enemies_init:
-                        Enemy(self, x, y, "Images/Entities/Enemies/Cop_",
-                              "Images/Entities/Enemies/Cop_shoot_",
-                              -1, self.main)
-                        self.enemies += 1
-                    Tile('empty', x, y, False, False, False, self.main)
-                elif level[y][x] == 'B':
-                    if self.enemies_init:
-                        Boss(self, x, y, 'Images/Entities/Boss/boss_r_',
-                             'Images/Entities/Boss/boss_shoot_', -1, self.main)
-                        self.enemies += 1
-                        self.boss = True
-                    Tile('empty', x, y, False, False, False, self.main)
-                if level[y][x] == 'R':
-                    Tile('rock', x, y, True, True, False, self.main)
-                elif level[y][x] == '0':
-                    Tile('hole', x, y, True, False, True, self.main)
-                elif level[y][x] == "A":
-                    Tile('empty', x, y, False, False, False, self.main)
-                    if self.artifacts_init:
-                        self.artifacts += 1
-                        Artifact(x, y, self.main)
-                elif level[y][x] == '^':
-                    self.door_up = Tile('door_up', x, y, False, True, False, self.main)
-                    if player_direction == 0 and self.filename != "start":
-                        new_player = Player(self, x, y + 1, self.main.player_image_file,
-                                            self.main.player_shoot_file,
-                                            -1, self.main, self.main.player_parameters)
-                elif level[y][x] == '>':
-                    self.door_right = Tile('door_right', x, y, False, True, False, self.main)
-                    if player_direction == 1 and self.filename != "start":
-                        new_player = Player(self, x - 1, y, self.main.player_image_file,
-                                            self.main.player_shoot_file,
-                                            -1, self.main, self.main.player_parameters)
-                elif level[y][x] == 'v':
-                    self.door_down = Tile('door_down', x, y, False, True, False, self.main)
-                    if player_direction == 2 and self.filename != "start":
-                        new_player = Player(self, x, y - 1, self.main.player_image_file,
-                                            self.main.player_shoot_file,
-                                            -1, self.main, self.main.player_parameters)
-                elif level[y][x] == '<':
-                    self.door_left = Tile('door_left', x, y, False, True, False, self.main)
-                    if player_direction == 3 and self.filename != "start":
-                        new_player = Player(self, x + 1, y, self.main.player_image_file,
-                                            self.main.player_shoot_file,
-                                            -1, self.main, self.main.player_parameters)
-        self.artifacts_init, self.enemies_init = False, False
-        return new_player, x, y
+        Draw the planned tiles on one surface. Only in the main thread
+        :param plan: result of plan_layers
+        :return: background, grid which blocks player, grid which blocks bullets
+        """
+        main = self.main
+        tiles, block_player_grid, block_bullets_grid = plan
+        background = pygame.Surface((main.WIDTH, main.HEIGHT), 0, main.screen)
+        for tile_type, position in tiles:
+            background.blit(main.tile_images[tile_type], position)
+        return background, block_player_grid, block_bullets_grid
 
-    def find_way(self, coords1, coords2):
+    def build_layers(self):
         """
-        Function for enemies to find the shortest way o player
+        Plan and draw the room at once
+        :return: background, grid which blocks player, grid which blocks bullets
+        """
+        return self.draw_layers(self.plan_layers())
+
+    def unload(self):
+        """
+        Forget the tiles and the background of the room (they are built again on the next
+        visit). Enemies and artifacts are kept, they are the state of the game
+        :return: None
+        """
+        for tile in self.tiles_group.sprites():
+            tile.kill()
+        self.door_up, self.door_right, self.door_down, self.door_left = None, None, None, None
+        self.block_player_grid, self.block_bullets_grid = None, None
+        self.background = None
+        self.invalidate_flow_field()
+
+    def draw_background(self, screen):
+        """
+        Draw the room background and doors on the screen
+        :param screen: surface where the room is drawn
+        :return: None
+        """
+        screen.blit(self.background, (0, 0))
+        self.tiles_group.draw(screen)
+
+    def set_block_player(self, tile, block_player):
+        """
+        Change blocking of the tile (door) and its cell in the collision grid
+        :param tile: tile which changes
+        :param block_player: must this tile block player motion
+        :return: None
+        """
+        tile.block_player = block_player
+        x, y = tile.rect.x // self.main.tile_width, tile.rect.y // self.main.tile_height
+        self.block_player_grid[y][x] = block_player
+
+    def collide_grid(self, rect, grid):
+        """
+        Check the collision of the rectangle with blocking cells of the grid.
+        Only the cells which the rectangle overlaps are checked
+        :param rect: rectangle to check
+        :param grid: collision grid of the room
+        :return: True if the rectangle overlaps a blocking cell or leaves the room
+        """
+        for y in range(rect.top // self.main.tile_height,
+                       (rect.bottom - 1) // self.main.tile_height + 1):
+            if not 0 <= y < len(grid):
+                return True
+            for x in range(rect.left // self.main.tile_width,
+                           (rect.right - 1) // self.main.tile_width + 1):
+                if not 0 <= x < len(grid[y]) or grid[y][x]:
+                    return True
+        return False
+
+    def invalidate_flow_field(self):
+        """
+        Forget the flow field. It must be called when the blocking layout of the room changes
+        :return: None
+        """
+        self.flow_field, self.flow_target = None, None
+
+    def update_flow_field(self, target):
+        """
+        Count the distance from every cell of the room to the target cell with BFS.
+        The field is recounted only when the target cell or the room layout changes
+        :param target: coords of the cell where all enemies go (player cell)
+        :return: list with distances (index is y * width + x, -1 if the cell is unreachable)
+        """
+        if self.flow_field is not None and self.flow_target == target:
+            return self.flow_field
+        height = len(self.room_map)
+        width = len(self.room_map[0])
+        field = [-1] * (width * height)
+        x, y = target
+        if 0 <= x < width and 0 <= y < height and self.room_map[y][x] != 0:
+            field[y * width + x] = 0
+            queue = deque([target])
+            while queue:
+                x, y = queue.popleft()
+                distance = field[y * width + x] + 1
+                for i in range(4):
+                    x3, y3 = x + DELTA_X[i], y + DELTA_Y[i]
+                    if 0 <= x3 < width and 0 <= y3 < height and field[y3 * width + x3] == -1 \
+                            and self.room_map[y3][x3] != 0:
+                        field[y3 * width + x3] = distance
+                        queue.append((x3, y3))
+        self.flow_field, self.flow_target = field, target
+        return field
+
+    def next_step(self, coords1, coords2):
+        """
+        Function for enemies to find the next cell of the shortest way to player
         :param coords1: coords enemy
         :param coords2: coords player
-        :return:
+        :return: coords of the next cell or None if there is no way
         """
-        x1, y1 = coords1
-        x2, y2 = coords2
-        delta_x = [1, 0, -1, 0]
-        delta_y = [0, 1, 0, -1]
-
-        test_board = []
+        field = self.update_flow_field(coords2)
         height = len(self.room_map)
         width = len(self.room_map[0])
-        for y in range(height):
-            test_board.append([])
-            for x in range(width):
-                if self.room_map[y][x] == 0:
-                    test_board[y].append(-1)
-                else:
-                    test_board[y].append(-2)
+        x, y = coords1
+        distance = field[y * width + x] if 0 <= x < width and 0 <= y < height else -1
+        step, step_distance = None, -1
+        for i in range(4):
+            x3, y3 = x + DELTA_X[i], y + DELTA_Y[i]
+            if 0 <= x3 < width and 0 <= y3 < height:
+                distance3 = field[y3 * width + x3]
+                if distance3 != -1 and (distance == -1 or distance3 < distance) and \
+                        (step is None or distance3 < step_distance):
+                    step, step_distance = (x3, y3), distance3
+        return step
 
-        counter = 0
-        test_board[y1][x1] = 0
-        while True:
-            stop = True
-            for y in range(height):
-                for x in range(width):
-                    if test_board[y][x] == counter:
-                        for i in range(4):
-                            x3, y3 = x + delta_x[i], y + delta_y[i]
-                            if 0 <= x3 < width and 0 <= y3 < height:
-                                if test_board[y3][x3] == -2:
-                                    stop = False
-                                    test_board[y3][x3] = counter + 1
-            counter += 1
-            if stop or test_board[y2][x2] != -2:
-                break
+    def find_way(self, coords1, coords2):
+        """
+        Function for enemies to find the shortest way o player
+        :param coords1: coords enemy
+        :param coords2: coords player
+        :return: list of cells from the player to the next cell of the enemy
+        """
         path = []
-        if test_board[y2][x2] == -2:
-            return []
-
-        x = x2
-        y = y2
-        counter = test_board[y2][x2]
-        while counter > 0:
-            path.append((x, y))
-            counter -= 1
-            for i in range(4):
-                x3, y3 = x + delta_x[i], y + delta_y[i]
-                if 0 <= x3 < width and 0 <= y3 < height:
-                    if test_board[y3][x3] == counter:
-                        x = x + delta_x[i]
-                        y = y + delta_y[i]
-                        break
+        step = self.next_step(coords1, coords2)
+        while step is not None:
+            path.append(step)
+            step = self.next_step(step, coords2)
+        path.reverse()
         return path
 
     def __repr__(self):
@@ -1002,12 +2542,17 @@ class Map:
         self.current_x = rooms_count
         self.current_y = rooms_count
         self.main = main
-        self.generate_map()
+        # rooms with built tiles and background, the last visited is the last
+        self.resident = OrderedDict()
+        # the branch of the map can come to a dead end, then the map is generated again
+        while not self.generate_map():
+            self.map = [[None] * (2 * rooms_count + 2) for _ in range(2 * rooms_count + 2)]
+            self.rooms = []
 
     def generate_map(self):
         """
         Generate stage map
-        :return: None
+        :return: False if a branch of the map came to a dead end, else True
         """
         x, y = self.current_x, self.current_y
         self.map[y][x] = Room("start", self.main)
@@ -1017,7 +2562,7 @@ class Map:
 
         directions = [0, 1, 2, 3]
         for elem in ['boss_room', "artifact_room", "shop"]:
-            direction = choice(directions)
+            direction = self.main.rng.choice(directions)
             special_rooms_directions[direction] = elem
             directions.remove(direction)
 
@@ -1030,19 +2575,22 @@ class Map:
                     direction = main_direction
                     x, y = get_coords((x, y), direction)
                 else:
-                    direction = choice(self.rooms[-1].exits)
+                    if not self.has_free_exit(self.rooms[-1], x, y, main_direction):
+                        return False
+                    direction = self.main.rng.choice(self.rooms[-1].exits)
                     coords = get_coords((x, y), direction)
                     while (self.map[coords[1]][coords[0]] is not None or
                            (direction + 2) % 4 == main_direction):
-                        direction = choice(self.rooms[-1].exits)
+                        direction = self.main.rng.choice(self.rooms[-1].exits)
                         coords = get_coords((x, y), direction)
                     x, y = get_coords((x, y), direction)
 
                 if i != self.rooms_count - 1:
-                    room = Room(choice(self.main.room_types), self.main)
-                    while (direction + 2) % 4 not in room.exits or not self.room_check_neighbours(
-                            room, x, y):
-                        room = Room(choice(self.main.room_types), self.main)
+                    template = self.main.levels.get(self.main.rng.choice(self.main.room_types))
+                    while (direction + 2) % 4 not in template.exits or \
+                            not self.room_check_neighbours(template, x, y):
+                        template = self.main.levels.get(self.main.rng.choice(self.main.room_types))
+                    room = Room(template.name, self.main)
                 else:
                     if main_direction in special_rooms_directions:
                         room = Room(special_rooms_directions[main_direction], self.main)
@@ -1058,11 +2606,27 @@ class Map:
                 else:
                     print("  ", end=" ")
             print()
+        return True
+
+    def has_free_exit(self, room, x, y, main_direction):
+        """
+        Checking that the branch of the map can be continued from the room
+        :param room: the last room of the branch
+        :param x: x coord of the room
+        :param y: y coord of the room
+        :param main_direction: direction of the branch
+        :return: True if there is an exit to the free place
+        """
+        for direction in room.exits:
+            coords = get_coords((x, y), direction)
+            if self.map[coords[1]][coords[0]] is None and (direction + 2) % 4 != main_direction:
+                return True
+        return False
 
     def room_check_neighbours(self, room, x, y):
         """
         Checking the neighbours room location
-        :param room: room for which you need to check neighbors
+        :param room: room (or level template) for which you need to check neighbors
         :param x: ordinat of this room
         :param y: abciss of this room
         :return: have this room the right neighbor
@@ -1076,6 +2640,32 @@ class Map:
     def get_current_room(self):
         return self.map[self.current_y][self.current_x]
 
+    def neighbours(self):
+        """
+        Rooms behind the exits of the current room which are not built yet
+        :return: list of rooms
+        """
+        rooms = []
+        for direction in self.get_current_room().exits:
+            x, y = get_coords((self.current_x, self.current_y), direction)
+            room = self.map[y][x]
+            if room is not None and (direction + 2) % 4 in room.exits and \
+                    room.background is None and room not in rooms:
+                rooms.append(room)
+        return rooms
+
+    def keep_resident(self, room):
+        """
+        Mark the room as just visited. When too many rooms are built, the room which was
+        visited long ago is unloaded
+        :param room: current room
+        :return: None
+        """
+        self.resident.pop(room, None)
+        self.resident[room] = True
+        while len(self.resident) > ROOMS_RESIDENT:
+            self.resident.popitem(last=False)[0].unload()
+
     def check_door(self):
         """
         Check can there be a door in this direction
@@ -1119,79 +2709,79 @@ class Map:
             if current_room.enemies != 0 or current_room.artifacts != 0:
                 current_room.door_up.image = self.main.tile_images[
                     'door_up_closed']
-                current_room.door_up.block_player = True
+                current_room.set_block_player(current_room.door_up, True)
             else:
                 current_room.door_up.image = self.main.tile_images[
                     'door_up']
-                current_room.door_up.block_player = False
+                current_room.set_block_player(current_room.door_up, False)
 
             if not room_up:
                 current_room.door_up.image = self.main.tile_images[
                     'door_up_closed']
-                current_room.door_up.block_player = True
+                current_room.set_block_player(current_room.door_up, True)
             elif 2 not in room_up.exits:
                 current_room.door_up.image = self.main.tile_images[
                     'door_up_closed']
-                current_room.door_up.block_player = True
+                current_room.set_block_player(current_room.door_up, True)
 
         if current_room.door_right is not None:
             if current_room.enemies != 0 or current_room.artifacts != 0:
                 current_room.door_right.image = self.main.tile_images[
                     'door_right_closed']
-                current_room.door_right.block_player = True
+                current_room.set_block_player(current_room.door_right, True)
             else:
                 current_room.door_right.image = self.main.tile_images[
                     'door_right']
-                current_room.door_right.block_player = False
+                current_room.set_block_player(current_room.door_right, False)
 
             if not room_right:
                 current_room.door_right.image = self.main.tile_images[
                     'door_right_closed']
-                current_room.door_right.block_player = True
+                current_room.set_block_player(current_room.door_right, True)
             elif 3 not in room_right.exits:
                 current_room.door_right.image = self.main.tile_images[
                     'door_right_closed']
-                current_room.door_right.block_player = True
+                current_room.set_block_player(current_room.door_right, True)
 
         if current_room.door_down is not None:
             if current_room.enemies != 0 or current_room.artifacts != 0:
                 current_room.door_down.image = self.main.tile_images[
                     'door_down_closed']
-                current_room.door_down.block_player = True
+                current_room.set_block_player(current_room.door_down, True)
             else:
                 current_room.door_down.image = self.main.tile_images[
                     'door_down']
-                current_room.door_down.block_player = False
+                current_room.set_block_player(current_room.door_down, False)
 
             if not room_down:
                 current_room.door_down.image = self.main.tile_images[
                     'door_down_closed']
-                current_room.door_down.block_player = True
+                current_room.set_block_player(current_room.door_down, True)
             elif 0 not in room_down.exits:
                 current_room.door_down.image = self.main.tile_images[
                     'door_down_closed']
-                current_room.door_down.block_player = True
+                current_room.set_block_player(current_room.door_down, True)
 
         if current_room.door_left is not None:
             if current_room.enemies != 0 or current_room.artifacts != 0:
                 current_room.door_left.image = self.main.tile_images[
                     'door_left_closed']
-                current_room.door_left.block_player = True
+                current_room.set_block_player(current_room.door_left, True)
             else:
                 current_room.door_left.image = self.main.tile_images[
                     'door_left']
-                current_room.door_left.block_player = False
+                current_room.set_block_player(current_room.door_left, False)
 
             if not room_left:
                 current_room.door_left.image = self.main.tile_images[
                     'door_left_closed']
-                current_room.door_left.block_player = True
+                current_room.set_block_player(current_room.door_left, True)
             elif 1 not in room_left.exits:
                 current_room.door_left.image = self.main.tile_images[
                     'door_left_closed']
-                current_room.door_left.block_player = True
-        if current_room.enemies == 0 and current_room.boss:
-            Artifact(6, 4, self.main, winner=True)
+                current_room.set_block_player(current_room.door_left, True)
+        if current_room.enemies == 0 and current_room.boss and current_room.prize is None:
+            current_room.prize = Artifact(6, 4, self.main, winner=True)
             # self.main.congratulations()
 
 
@@ -1215,6 +2805,162 @@ class Tile(pygame.sprite.Sprite):
         self.damage_player = damage_player
 
 
+# size of the cells of the spatial hash in pixels (one tile)
+SPATIAL_CELL = 50
+# number of cells in one row of the bullets hash key (more than cells across the window)
+SPATIAL_ROW = 1024
+
+
+class SpatialHash:
+    def __init__(self, cell=SPATIAL_CELL):
+        """
+        initialization of class SpatialHash. Sprites are registered in every cell of the grid
+        which their rectangles overlap, so collision checks look only at the sprites nearby
+        :param cell: size of the cell in pixels
+        """
+        self.cell = cell
+        self.cells, self.sprite_cells = {}, {}
+
+    def span_of(self, rect):
+        """
+        Range of the cells which the rectangle overlaps
+        :param rect: rectangle
+        :return: first and last cell columns and rows
+        """
+        cell = self.cell
+        return (rect.left // cell, rect.top // cell, (rect.right - 1) // cell,
+                (rect.bottom - 1) // cell)
+
+    @staticmethod
+    def cells_of(span):
+        """
+        Cells of the range
+        :param span: first and last cell columns and rows
+        :return: list of cell coords
+        """
+        left, top, right, bottom = span
+        return [(x, y) for y in range(top, bottom + 1) for x in range(left, right + 1)]
+
+    def clear(self):
+        """
+        Remove all sprites
+        :return: None
+        """
+        self.cells, self.sprite_cells = {}, {}
+
+    def add(self, sprite):
+        """
+        Register the sprite in the cells of its rectangle
+        :param sprite: sprite
+        :return: None
+        """
+        span = self.span_of(sprite.rect)
+        self.sprite_cells[sprite] = span
+        for key in self.cells_of(span):
+            self.cells.setdefault(key, []).append(sprite)
+
+    def remove(self, sprite):
+        """
+        Remove the sprite (when it is killed)
+        :param sprite: sprite
+        :return: None
+        """
+        if sprite in self.sprite_cells:
+            for key in self.cells_of(self.sprite_cells.pop(sprite)):
+                self.cells[key].remove(sprite)
+
+    def update(self, sprite):
+        """
+        Move the sprite to the cells of its new rectangle. It must be called after the sprite
+        moves
+        :param sprite: sprite
+        :return: None
+        """
+        span = self.sprite_cells.get(sprite)
+        if span is not None and span != self.span_of(sprite.rect):
+            self.remove(sprite)
+            self.add(sprite)
+
+    def collide(self, rect, ignored=None):
+        """
+        Check the collision of the rectangle with sprites of the nearby cells
+        :param rect: rectangle to check
+        :param ignored: sprite which is not checked (the sprite which moves)
+        :return: True if the rectangle overlaps any sprite
+        """
+        cell, cells = self.cell, self.cells
+        left, right = rect.left // cell, (rect.right - 1) // cell
+        for y in range(rect.top // cell, (rect.bottom - 1) // cell + 1):
+            for x in range(left, right + 1):
+                for sprite in cells.get((x, y), ()):
+                    if sprite is not ignored and rect.colliderect(sprite.rect):
+                        return True
+        return False
+
+
+# time in microseconds which the enemies may spend on decisions in one frame
+# (or PUNKS_AI_BUDGET environment variable)
+AI_BUDGET = 1000
+# time in microseconds which one decision is charged in the headless mode instead of the
+# measured time, so the seeded runs are replayed in the same way on every computer
+# (one decision takes about 5 microseconds)
+AI_DECISION_COST = 5
+
+
+class AIScheduler:
+    def __init__(self, budget=AI_BUDGET, decision_cost=None):
+        """
+        initialization of class AIScheduler. Every frame the enemies think in turn until the
+        budget is spent, the others act on their last decisions and think in the next frames.
+        Only the decisions are charged to the budget, the movement and shooting of every enemy
+        are done in every frame
+        :param budget: time for decisions in one frame in microseconds
+        :param decision_cost: fixed time of one decision in microseconds (None - the decisions
+                              are charged their measured time)
+        """
+        self.budget = budget
+        self.decision_cost = decision_cost
+        # place in the list of enemies where the decisions of the next frame start
+        self.cursor = 0
+        self.decisions, self.deferred = 0, 0
+        # time charged for the decisions in the last frame (seconds)
+        self.spent = 0
+        # clock of the decisions (the benchmark counts only the processor time of the thread)
+        self.clock = time.perf_counter
+
+    def run(self, enemies):
+        """
+        One frame of the enemies. At least one enemy thinks in every frame
+        :param enemies: group of enemies of the room
+        :return: None
+        """
+        self.spent = 0
+        enemies = enemies.sprites()
+        if not enemies:
+            return
+        start = self.cursor % len(enemies)
+        budget = self.budget / 1000000
+        deciding = True
+        for index, enemy in enumerate(enemies[start:] + enemies[:start]):
+            if deciding and index and self.spent >= budget:
+                deciding = False
+                self.cursor = start + index
+                self.deferred += len(enemies) - index
+            if deciding:
+                self.decisions += 1
+            spent = enemy.act(deciding)
+            if deciding and self.decision_cost is not None:
+                spent = self.decision_cost / 1000000
+            self.spent += spent
+
+    def stats(self):
+        """
+        Statistics of the scheduler
+        :return: dict with count of made and deferred decisions
+        """
+        return {'decisions': self.decisions, 'deferred': self.deferred}
+
+
 class Enemy(pygame.sprite.Sprite):
     def __init__(self, room, pos_x, pos_y, image, shooting_image, direction, main):
         """
@@ -1222,28 +2968,25 @@ class Enemy(pygame.sprite.Sprite):
                 :param room: parameter for accessing the room class
                 :param pos_x: Enemy position x
                 :param pos_y: Enemy position y
-                :param image: file which plays when entity run
-                :param shooting_image: file which plays when entity shoot
+                :param image: animation set which plays when entity run
+                :param shooting_image: animation set which plays when entity shoot
                 :param direction: direction where entity look after spawn
                 :param main: parameter for accessing the main class
                 """
         super().__init__(main.enemy_group, main.all_sprites)
-        self.running, self.reversed, self.image_gif, self.frames = None, None, None, None
+        self.running, self.reversed, self.frames = None, None, None
         self.startpoint, self.ptime, self.breakpoint, self.image = None, None, None, None
         self.image, self.main, self.room, self.map, self.x = None, main, room, Map, pos_x
         self.direction, self.y, self.count = direction, pos_y, 0
+        # last decisions of the AI: next cell of the path and direction of the shot
+        self.step, self.aim = None, None
+        # sizes of the bullet of the enemy for every direction (for the line-up checks)
+        self.bullet_sizes = {side: frames[0][0].get_size()
+                             for side, frames in main.assets.get('tear').items()}
         self.hp = main.diff_parameters[main.diff_image][2]
         self.speed = main.diff_parameters[main.diff_image][4]
-        self.image_gif = None
-        self.images = {0: Image.open(image + "run_up.gif"),
-                       1: Image.open(image + "run_right.gif"),
-                       2: Image.open(image + "run_down.gif"),
-                       3: Image.open(image + "run_left.gif"),
-                       -1: Image.open(image + "stay.gif")}
-        self.shooting_images = {0: Image.open(shooting_image + "up.gif"),
-                                1: Image.open(shooting_image + "right.gif"),
-                                2: Image.open(shooting_image + "down.gif"),
-                                3: Image.open(shooting_image + "left.gif")}
+        self.images = image
+        self.shooting_images = shooting_image
         self.change_image(self.images, direction)
         self.rect = self.image.get_rect().move(self.main.tile_width * pos_x,
                                                self.main.tile_height * pos_y)
@@ -1279,11 +3022,10 @@ class Enemy(pygame.sprite.Sprite):
         :param direction:
         :return: None
         """
-        if self.image_gif != image_group[direction]:
-            self.running, self.reversed, self.image_gif = True, False, image_group[direction]
-            self.frames, self.startpoint, self.cur, = [], 0, 0
+        if self.frames is not image_group[direction]:
+            self.running, self.reversed, self.frames = True, False, image_group[direction]
+            self.startpoint, self.cur = 0, 0
             self.ptime = time.time()
-            get_frames(self)
             self.breakpoint = len(self.frames) - 1
             self.render()
             self.direction = direction
@@ -1294,123 +3036,144 @@ class Enemy(pygame.sprite.Sprite):
         :param direction: where enemy must shoot
         :return: None
         """
-        self.main.music.shoot('enemy')
         self.change_image(self.shooting_images, direction)
         if self.count % self.main.shooting_tick_delay == 0:
-            Bullet(self.rect.x + self.main.player_size_x // 2 - 5,
-                   self.rect.y + self.main.player_size_y // 2 - 5,
-                   "Images/Bullets/tear_", direction, 5, self.main.player_group, self.main)
+            self.main.music.shoot('enemy')
+            self.main.bullets.spawn(self.rect.x + self.main.player_size_x // 2 - 5,
+                                    self.rect.y + self.main.player_size_y // 2 - 5,
+                                    self.main.assets.get('tear'), direction, 5,
+                                    self.main.player_group)
         self.count += 1
 
     def check_player_coords(self):
         """
         Function which check the player position
-        :return: can enemy shoot or not
+        :return: direction where enemy can shoot or None
         """
         if (self.main.player.rect.x - 10 <= self.rect.x <= self.main.player.rect.x + 10 and
                 self.main.player.rect.y <= self.rect.y):
-            self.shoot(0)
-            return True
+            direction = 0
         elif (self.main.player.rect.x - 10 <= self.rect.x <= self.main.player.rect.x + 10 and
               self.main.player.rect.y >= self.rect.y):
-            self.shoot(2)
-            return True
+            direction = 2
         elif (self.main.player.rect.y - self.main.player_size_y
               <= self.rect.y <= self.main.player.rect.y + self.main.player_size_x and
               self.main.player.rect.x <= self.rect.x):
-            self.shoot(3)
-            return True
+            direction = 3
         elif (self.main.player.rect.y - self.main.player_size_y
               <= self.rect.y <= self.main.player.rect.y + self.main.player_size_x and
               self.main.player.rect.x >= self.rect.x):
-            self.shoot(1)
-            return True
+            direction = 1
         else:
+            return None
+        if self.room.template.clear_shot(direction, self.bullet_cells(direction),
+                                         self.cells_of(self.main.player.rect)):
+            return direction
+        return None
+
+    def bullet_cells(self, direction):
+        """
+        Cells which the bullet of the enemy overlaps when it is shot (like in shoot)
+        :param direction: direction of the shot
+        :return: cells (left, top, right, bottom)
+        """
+        width, height = self.bullet_sizes[direction]
+        return self.cells_of(pygame.Rect(self.rect.x + self.main.player_size_x // 2 - 5,
+                                         self.rect.y + self.main.player_size_y // 2 - 5,
+                                         width, height))
+
+    def cells_of(self, rect):
+        """
+        Cells which the rectangle overlaps
+        :param rect: rectangle
+        :return: cells (left, top, right, bottom)
+        """
+        return (rect.left // self.main.tile_width, rect.top // self.main.tile_height,
+                (rect.right - 1) // self.main.tile_width,
+                (rect.bottom - 1) // self.main.tile_height)
+
+    def act(self, decide):
+        """
+        One frame of the enemy. Movement and shooting follow the last decisions, the decisions
+        are made again only when the AI scheduler lets the enemy think
+        :param decide: make new decisions in this frame
+        :return: time spent on the decisions (seconds)
+        """
+        clock, spent = self.main.ai.clock, 0
+        if decide:
+            start = clock()
+            self.step = self.room.next_step(
+                self.get_pos(self.rect.x, self.rect.y),
+                self.get_pos(self.room.player.rect.x, self.room.player.rect.y))
+            spent = clock() - start
+        self.move()
+        self.render()
+        if decide:
+            start = clock()
+            self.aim = self.check_player_coords()
+            spent += clock() - start
+        if self.aim is None:
             self.change_image(self.images, -1)
+        else:
+            self.shoot(self.aim)
+        self.check_collision()
+        return spent
 
     def check_collision(self):
         """
         Check collision between enemy and other subjects
         :return: None
         """
-        if pygame.sprite.spritecollideany(self, self.main.bullet_group, False):
-            if pygame.sprite.spritecollideany(self, self.main.bullet_group,
-                                              False).sprites_to_damage == self.main.enemy_group:
-                self.hp -= self.main.player.attack()
-                self.main.music.ouch('enemy')
-                if self.hp - self.main.player.attack() <= 0:
-                    self.kill()
-                    self.room.enemies -= 1
-                    if self.room.enemies == 0:
-                        self.main.game_map.update_doors()
-
-                print('Ouch!', self.hp)
+        if self.main.bullets.first_hit(self.rect) is self.main.enemy_group:
+            self.hp -= self.main.player.attack()
+            self.main.music.ouch('enemy')
+            if self.hp - self.main.player.attack() <= 0:
+                self.kill()
+                self.main.bodies.remove(self)
+                self.room.enemies -= 1
+                if self.room.enemies == 0:
+                    self.main.game_map.update_doors()
+
+            print('Ouch!', self.hp)
         # if pygame.sprite.spritecollideany(self, self.main.player_group, False):
         #     print('Go away!')
 
     def move(self):
         """
-        Function for move enemiies
+        Function for move enemiies to the next cell of the path
         :return: None
         """
-        if self.room.find_way(self.get_pos(self.rect.x, self.rect.y),
-                              self.get_pos(self.room.player.rect.x, self.room.player.rect.y)):
-            x1, y1 = self.room.find_way(self.get_pos(self.rect.x, self.rect.y),
-                                        self.get_pos(self.room.player.rect.x,
-                                                     self.room.player.rect.y))[-1]
+        if self.step is not None:
+            x1, y1 = self.step
 
             if self.rect.y < y1 * 50:
                 collision_test_rect = pygame.Rect((self.rect.x, self.rect.y + self.speed),
                                                   (self.main.player_size_x, self.main.player_size_y))
-                if collision_test_rect.collidelist(
-                        [elem.rect if elem != self else pygame.Rect((0, 0), (0, 0)) for elem in
-                         self.main.enemy_group]) == -1:
-                    if collision_test_rect.collidelist(
-                            [elem.rect if elem.block_player else pygame.Rect((0, 0), (0, 0)) for elem
-                             in
-                             self.main.tiles_group]) == -1:
-                        if collision_test_rect.collidelist(
-                                [elem.rect for elem in self.main.player_group]) == -1:
-                            self.rect.y += self.speed
+                if not self.main.bodies.collide(collision_test_rect, self):
+                    if not self.room.collide_grid(collision_test_rect, self.room.block_player_grid):
+                        self.rect.y += self.speed
+                        self.main.bodies.update(self)
             elif self.rect.y > y1 * 50:
                 collision_test_rect = pygame.Rect((self.rect.x, self.rect.y - self.speed),
                                                   (self.main.player_size_x, self.main.player_size_y))
-                if collision_test_rect.collidelist(
-                        [elem.rect if elem != self else pygame.Rect((0, 0), (0, 0)) for elem in
-                         self.main.enemy_group]) == -1:
-                    if collision_test_rect.collidelist(
-                            [elem.rect if elem.block_player else pygame.Rect((0, 0), (0, 0)) for elem
-                             in
-                             self.main.tiles_group]) == -1:
-                        if collision_test_rect.collidelist(
-                                [elem.rect for elem in self.main.player_group]) == -1:
-                            self.rect.y -= self.speed
+                if not self.main.bodies.collide(collision_test_rect, self):
+                    if not self.room.collide_grid(collision_test_rect, self.room.block_player_grid):
+                        self.rect.y -= self.speed
+                        self.main.bodies.update(self)
             if self.rect.x < x1 * 50:
                 collision_test_rect = pygame.Rect((self.rect.x + self.speed, self.rect.y),
                                                   (self.main.player_size_x, self.main.player_size_y))
-                if collision_test_rect.collidelist(
-                        [elem.rect if elem != self else pygame.Rect((0, 0), (0, 0)) for elem in
-                         self.main.enemy_group]) == -1:
-                    if collision_test_rect.collidelist(
-                            [elem.rect if elem.block_player else pygame.Rect((0, 0), (0, 0)) for elem
-                             in
-                             self.main.tiles_group]) == -1:
-                        if collision_test_rect.collidelist(
-                                [elem.rect for elem in self.main.player_group]) == -1:
-                            self.rect.x += self.speed
+                if not self.main.bodies.collide(collision_test_rect, self):
+                    if not self.room.collide_grid(collision_test_rect, self.room.block_player_grid):
+                        self.rect.x += self.speed
+                        self.main.bodies.update(self)
             elif self.rect.x > x1 * 50:
                 collision_test_rect = pygame.Rect((self.rect.x - self.speed, self.rect.y),
                                                   (self.main.player_size_x, self.main.player_size_y))
-                if collision_test_rect.collidelist(
-                        [elem.rect if elem != self else pygame.Rect((0, 0), (0, 0)) for elem in
-                         self.main.enemy_group]) == -1:
-                    if collision_test_rect.collidelist(
-                            [elem.rect if elem.block_player else pygame.Rect((0, 0), (0, 0)) for elem
-                             in
-                             self.main.tiles_group]) == -1:
-                        if collision_test_rect.collidelist(
-                                [elem.rect for elem in self.main.player_group]) == -1:
-                            self.rect.x -= self.speed
+                if not self.main.bodies.collide(collision_test_rect, self):
+                    if not self.room.collide_grid(collision_test_rect, self.room.block_player_grid):
+                        self.rect.x -= self.speed
+                        self.main.bodies.update(self)
 
     def get_pos(self, x, y):
         return x // 50, y // 50
@@ -1423,31 +3186,13 @@ class Boss(Enemy):
                 :param room: parameter for accessing the room class
                 :param pos_x: Enemy position x
                 :param pos_y: Enemy position y
-                :param image: file which plays when entity run
-                :param shooting_image: file which plays when entity shoot
+                :param image: animation set which plays when entity run
+                :param shooting_image: animation set which plays when entity shoot
                 :param direction: direction where entity look after spawn
                 :param main: parameter for accessing the main class
                 """
         super().__init__(room, pos_x, pos_y, image, shooting_image, direction, main)
-        self.running, self.reversed, self.image_gif, self.frames = None, None, None, None
-        self.startpoint, self.ptime, self.breakpoint, self.image = None, None, None, None
-        self.image, self.main, self.room, self.map, self.x = None, main, room, Map, pos_x
-        self.direction, self.y, self.count = direction, pos_y, 0
         self.hp = main.diff_parameters[main.diff_image][1]
-        self.speed = main.diff_parameters[main.diff_image][4]
-        self.image_gif = None
-        self.images = {0: Image.open(image + "run_up.gif"),
-                       1: Image.open(image + "run_right.gif"),
-                       2: Image.open(image + "run_down.gif"),
-                       3: Image.open(image + "run_left.gif"),
-                       -1: Image.open(image + "stay.gif")}
-        self.shooting_images = {0: Image.open(shooting_image + "up.gif"),
-                                1: Image.open(shooting_image + "right.gif"),
-                                2: Image.open(shooting_image + "down.gif"),
-                                3: Image.open(shooting_image + "left.gif")}
-        self.change_image(self.images, direction)
-        self.rect = self.image.get_rect().move(self.main.player_size_x * pos_x,
-                                               self.main.player_size_y * pos_y)
 
 
 class Player(pygame.sprite.Sprite):
@@ -1458,23 +3203,18 @@ class Player(pygame.sprite.Sprite):
         :param room: parameter for accessing the room class
         :param pos_x: Player position x
         :param pos_y: Player position y
-        :param image: file which plays when entity run
-        :param shooting_image: file which plays when entity shoot
+        :param image: animation set which plays when entity run
+        :param shooting_image: animation set which plays when entity shoot
         :param direction: direction where entity look after spawn
         :param main: parameter for accessing the main class
         """
         super().__init__(main.player_group, main.all_sprites)
-        self.running, self.reversed, self.image_gif, self.frames = None, None, None, None
+        self.running, self.reversed, self.frames = None, None, None
         self.startpoint, self.ptime, self.breakpoint, self.image = None, None, None, None
         self.cur, self.main, self.room, self.direction, \
         self.player_parameters = None, main, room, direction, parameters
-        self.images = {0: Image.open(image + "run_up.gif"), 1: Image.open(image + "run_right.gif"),
-                       2: Image.open(image + "run_down.gif"), 3: Image.open(image + "run_left.gif"),
-                       -1: Image.open(image + "stay.gif")}
-        self.shooting_images = {0: Image.open(shooting_image + "up.gif"),
-                                1: Image.open(shooting_image + "right.gif"),
-                                2: Image.open(shooting_image + "down.gif"),
-                                3: Image.open(shooting_image + "left.gif")}
+        self.images = image
+        self.shooting_images = shooting_image
         self.change_image(self.images, direction)
         self.rect = self.image.get_rect().move(self.main.tile_width * pos_x,
                                                self.main.tile_height * pos_y)
@@ -1501,11 +3241,10 @@ class Player(pygame.sprite.Sprite):
         self.running = True
 
     def change_image(self, image_group, direction):
-        if self.image_gif != image_group[direction]:
-            self.running, self.reversed, self.image_gif = True, False, image_group[direction]
-            self.frames, self.startpoint, self.cur, = [], 0, 0
+        if self.frames is not image_group[direction]:
+            self.running, self.reversed, self.frames = True, False, image_group[direction]
+            self.startpoint, self.cur = 0, 0
             self.ptime = time.time()
-            get_frames(self)
             self.breakpoint = len(self.frames) - 1
             self.render()
             self.direction = direction
@@ -1514,19 +3253,29 @@ class Player(pygame.sprite.Sprite):
         if direction != self.direction:
             self.change_image(self.images, direction)
 
+    def enter(self, room, pos_x, pos_y):
+        """
+        Move the player into the room
+        :param room: room where the player comes in
+        :param pos_x: Player position x
+        :param pos_y: Player position y
+        :return: None
+        """
+        self.room = room
+        self.change_image(self.images, -1)
+        self.rect.topleft = self.main.tile_width * pos_x, self.main.tile_height * pos_y
+
     def check_collision(self):
         """
         Check collision between player and other subjects
         :return: None
         """
-        if pygame.sprite.spritecollideany(self, self.main.bullet_group, False):
-            if pygame.sprite.spritecollideany(self, self.main.bullet_group,
-                                              False).sprites_to_damage == self.main.player_group:
-                self.player_parameters[5] -= 1
-                if self.player_parameters[5] <= 0:
-                    self.main.game_over()
-                print('Ouch!', self.player_parameters[5])
-                self.main.music.ouch('hero')
+        if self.main.bullets.first_hit(self.rect) is self.main.player_group:
+            self.player_parameters[5] -= 1
+            if self.player_parameters[5] <= 0:
+                self.main.game_over()
+            print('Ouch!', self.player_parameters[5])
+            self.main.music.ouch('hero')
 
     def move(self, direction):
         """
@@ -1538,39 +3287,31 @@ class Player(pygame.sprite.Sprite):
         if direction == 0:
             collision_test_rect = pygame.Rect((self.rect.x, self.rect.y - player_speed),
                                               (self.main.player_size_x, self.main.player_size_y))
-            if collision_test_rect.collidelist(
-                    [elem.rect if elem.block_player else pygame.Rect((0, 0), (0, 0)) for elem in
-                     self.main.tiles_group]) == -1:
-                if collision_test_rect.collidelist(
-                        [elem.rect for elem in self.main.enemy_group]) == -1:
+            if not self.room.collide_grid(collision_test_rect, self.room.block_player_grid):
+                if not self.main.bodies.collide(collision_test_rect, self):
                     self.rect.y -= player_speed
+                    self.main.bodies.update(self)
         if direction == 2:
             collision_test_rect = pygame.Rect((self.rect.x, self.rect.y + player_speed),
                                               (self.main.player_size_x, self.main.player_size_y))
-            if collision_test_rect.collidelist(
-                    [elem.rect if elem.block_player else pygame.Rect((0, 0), (0, 0)) for elem in
-                     self.main.tiles_group]) == -1:
-                if collision_test_rect.collidelist(
-                        [elem.rect for elem in self.main.enemy_group]) == -1:
+            if not self.room.collide_grid(collision_test_rect, self.room.block_player_grid):
+                if not self.main.bodies.collide(collision_test_rect, self):
                     self.rect.y += player_speed
+                    self.main.bodies.update(self)
         if direction == 3:
             collision_test_rect = pygame.Rect((self.rect.x - player_speed, self.rect.y),
                                               (self.main.player_size_x, self.main.player_size_y))
-            if collision_test_rect.collidelist(
-                    [elem.rect if elem.block_player else pygame.Rect((0, 0), (0, 0)) for elem in
-                     self.main.tiles_group]) == -1:
-                if collision_test_rect.collidelist(
-                        [elem.rect for elem in self.main.enemy_group]) == -1:
+            if not self.room.collide_grid(collision_test_rect, self.room.block_player_grid):
+                if not self.main.bodies.collide(collision_test_rect, self):
                     self.rect.x -= player_speed
+                    self.main.bodies.update(self)
         if direction == 1:
             collision_test_rect = pygame.Rect((self.rect.x + player_speed, self.rect.y),
                                               (self.main.player_size_x, self.main.player_size_y))
-            if collision_test_rect.collidelist(
-                    [elem.rect if elem.block_player else pygame.Rect((0, 0), (0, 0)) for elem in
-                     self.main.tiles_group]) == -1:
-                if collision_test_rect.collidelist(
-                        [elem.rect for elem in self.main.enemy_group]) == -1:
+            if not self.room.collide_grid(collision_test_rect, self.room.block_player_grid):
+                if not self.main.bodies.collide(collision_test_rect, self):
                     self.rect.x += player_speed
+                    self.main.bodies.update(self)
 
     def shoot(self, direction):
         """
@@ -1579,10 +3320,10 @@ class Player(pygame.sprite.Sprite):
         :return: None
         """
         self.change_image(self.shooting_images, direction)
-        Bullet(self.rect.x + self.main.player_size_x // 2 - 5,
-               self.rect.y + self.main.player_size_y // 2 - 5,
-               "Images/Bullets/bottle_", direction, self.main.player.player_parameters[3],
-               self.main.enemy_group, self.main)
+        self.main.bullets.spawn(self.rect.x + self.main.player_size_x // 2 - 5,
+                                self.rect.y + self.main.player_size_y // 2 - 5,
+                                self.main.assets.get('bottle'), direction,
+                                self.main.player.player_parameters[3], self.main.enemy_group)
         self.main.music.shoot('hero')
 
     def attack(self):
@@ -1592,101 +3333,249 @@ class Player(pygame.sprite.Sprite):
         return x // 50, y // 50
 
 
-class Bullet(pygame.sprite.Sprite):
-    def __init__(self, x, y, image, direction, bullet_speed, sprites_to_damage, main):
+# moves of the bullets for the directions up, right, down and left
+BULLET_DX = np.array([0, 1, 0, -1])
+BULLET_DY = np.array([-1, 0, 1, 0])
+# arrays with the state of the bullets
+BULLET_FIELDS = ('x', 'y', 'width', 'height', 'direction', 'speed', 'target', 'frame_set',
+                 'frame', 'ptime')
+
+
+class BulletEngine:
+    def __init__(self, main):
         """
-        Initializing of class Bullet
-        :param x: Bullet position x
-        :param y: Bullet position y
-        :param image: file which plays when entity run
-        :param direction: direction where entity look after spawn
-        :param bullet_speed: bullet speed
-        :param sprites_to_damage: which sprites need to damage
+        initialization of class BulletEngine. All bullets of the room are stored in arrays
+        (position, size, direction, speed, target and animation phase), so they are moved,
+        checked and drawn together. The order of the bullets is the order of the shots
         :param main: parameter for accessing the main class
         """
-        super().__init__(main.bullet_group, main.all_sprites)
-        self.image = None
         self.main = main
-        self.direction = direction
-        self.bullet_speed = bullet_speed
-        self.images = {0: Image.open(image + "up.gif"),
-                       1: Image.open(image + "right.gif"),
-                       2: Image.open(image + "down.gif"),
-                       3: Image.open(image + "left.gif")}
-        self.running = True
-        self.reversed = False
-        self.image_gif = self.images[direction]
-        self.frames = []
-        self.startpoint = 0
-        self.ptime = time.time()
-        self.cur = 0
-        get_frames(self)
-        self.breakpoint = len(self.frames) - 1
-        self.render()
-        self.rect = self.image.get_rect().move(x, y)
-        self.sprites_to_damage = sprites_to_damage
-        self.walls = []
-        for elem in self.main.tiles_group:
-            if elem.block_bullets:
-                self.walls.append(elem)
+        # animations of the bullets and durations of their frames (one row for one animation)
+        self.frame_sets, self.frame_set_ids = [], {}
+        self.durations, self.lengths = np.zeros((0, 0)), np.zeros(0, dtype=np.int64)
+        self.grid, self.grid_source = None, None
+        # sides of the bullets and their spatial hash (they are made when they are needed)
+        self.targets, self.spawned, self.sides, self.cells = [], [], None, None
+        self.clear()
 
-    def check_collision(self):
+    def clear(self):
         """
-        Check collision between bullet and other subjects
+        Remove all bullets
         :return: None
         """
-        if pygame.sprite.spritecollideany(self, self.walls):
-            self.kill()
-        if pygame.sprite.spritecollideany(self, self.sprites_to_damage):
-            self.kill()
+        for field in BULLET_FIELDS:
+            setattr(self, field, np.zeros(0, dtype=float if field == 'ptime' else np.int64))
+        # groups of sprites which bullets damage (target is the index in this list)
+        self.targets, self.spawned, self.sides, self.cells = [], [], None, None
 
-    def move(self):
+    def __len__(self):
+        return len(self.x) + len(self.spawned)
+
+    def spawn(self, x, y, images, direction, bullet_speed, sprites_to_damage):
         """
-        Function for moving bullet
+        Shoot the new bullet
+        :param x: Bullet position x
+        :param y: Bullet position y
+        :param images: animation set of the bullet
+        :param direction: direction of the bullet
+        :param bullet_speed: bullet speed
+        :param sprites_to_damage: which sprites need to damage
         :return: None
         """
-        self.check_collision()
-        if self.direction == 0:
-            self.rect.y -= self.bullet_speed
-        elif self.direction == 1:
-            self.rect.x += self.bullet_speed
-        elif self.direction == 2:
-            self.rect.y += self.bullet_speed
-        elif self.direction == 3:
-            self.rect.x -= self.bullet_speed
+        frames = images[direction]
+        width, height = frames[0][0].get_size()
+        for target, group in enumerate(self.targets):
+            if group is sprites_to_damage:
+                break
+        else:
+            target = len(self.targets)
+            self.targets.append(sprites_to_damage)
+        self.spawned.append((x, y, width, height, direction, bullet_speed, target,
+                             self.animation_index(frames), 0, time.time()))
 
-    def render(self):
-        if self.running:
-            if time.time() - self.ptime > self.frames[self.cur][1]:
-                if self.reversed:
-                    self.cur -= 1
-                    if self.cur < self.startpoint:
-                        self.cur = self.breakpoint
-                else:
-                    self.cur += 1
-                    if self.cur > self.breakpoint:
-                        self.cur = self.startpoint
+    def animation_index(self, frames):
+        """
+        Number of the animation in the table of frame durations
+        :param frames: list of frames and their durations
+        :return: index of the animation
+        """
+        if id(frames) not in self.frame_set_ids:
+            self.frame_set_ids[id(frames)] = len(self.frame_sets)
+            self.frame_sets.append(frames)
+            self.lengths = np.array([len(frame_set) for frame_set in self.frame_sets])
+            self.durations = np.full((len(self.frame_sets), self.lengths.max()), np.inf)
+            for i, frame_set in enumerate(self.frame_sets):
+                self.durations[i, :len(frame_set)] = [duration for _, duration in frame_set]
+        return self.frame_set_ids[id(frames)]
 
-                self.ptime = time.time()
-        self.image = self.frames[self.cur][0]
+    def flush(self):
+        """
+        Add the bullets shot since the last flush to the arrays
+        :return: None
+        """
+        if self.spawned:
+            for field, values in zip(BULLET_FIELDS, zip(*self.spawned)):
+                setattr(self, field, np.concatenate((getattr(self, field), values)))
+            if self.sides is not None:
+                for x, y, width, height in (bullet[:4] for bullet in self.spawned):
+                    self.add_to_cells(len(self.sides), x, y, x + width, y + height)
+            self.spawned = []
 
-    def pause(self):
-        self.running = False
+    def keep(self, alive):
+        """
+        Remove the bullets which are not alive
+        :param alive: bool array, True for bullets which stay
+        :return: None
+        """
+        for field in BULLET_FIELDS:
+            setattr(self, field, getattr(self, field)[alive])
+        self.sides, self.cells = None, None
+
+    def overlap(self, left, top, right, bottom):
+        """
+        Check which bullets overlap the rectangles (like Rect.colliderect)
+        :param left: left side of the rectangle (number or array)
+        :param top: top side of the rectangle
+        :param right: right side of the rectangle
+        :param bottom: bottom side of the rectangle
+        :return: bool array
+        """
+        return ((self.x < right) & (left < self.x + self.width) &
+                (self.y < bottom) & (top < self.y + self.height))
+
+    def grid_hits(self, room):
+        """
+        Check which bullets overlap cells blocking bullets or leave the room (like
+        Room.collide_grid). Bullets are not bigger than a tile, so only corner cells are checked
+        :param room: current room
+        :return: bool array
+        """
+        if self.grid_source is not room.block_bullets_grid:
+            self.grid_source = room.block_bullets_grid
+            # cells around the room block bullets too
+            self.grid = np.pad(np.array(room.block_bullets_grid, dtype=bool), 1,
+                               constant_values=True)
+        height, width = self.grid.shape
+        left = np.minimum(np.maximum(self.x // self.main.tile_width + 1, 0), width - 1)
+        top = np.minimum(np.maximum(self.y // self.main.tile_height + 1, 0), height - 1)
+        right = np.minimum(np.maximum((self.x + self.width - 1) // self.main.tile_width + 1, 0),
+                           width - 1)
+        bottom = np.minimum(np.maximum((self.y + self.height - 1) // self.main.tile_height + 1,
+                                       0), height - 1)
+        return (self.grid[top, left] | self.grid[top, right] | self.grid[bottom, left] |
+                self.grid[bottom, right])
+
+    def target_hits(self):
+        """
+        Check which bullets overlap any sprite which they damage
+        :return: bool array
+        """
+        hits = np.zeros(len(self.x), dtype=bool)
+        for target, group in enumerate(self.targets):
+            rects = np.array([tuple(sprite.rect) for sprite in group]).reshape(-1, 1, 4)
+            if not len(rects):
+                continue
+            hits |= (self.target == target) & self.overlap(
+                rects[..., 0], rects[..., 1], rects[..., 0] + rects[..., 2],
+                rects[..., 1] + rects[..., 3]).any(axis=0)
+        return hits
+
+    def move(self, room):
+        """
+        Remove the bullets which hit walls or sprites which they damage and move the others
+        :param room: current room
+        :return: None
+        """
+        self.flush()
+        if not len(self.x):
+            return
+        self.keep(~(self.grid_hits(room) | self.target_hits()))
+        if not len(self.x):
+            return
+        self.x += BULLET_DX[self.direction] * self.speed
+        self.y += BULLET_DY[self.direction] * self.speed
+
+    def first_hit(self, rect):
+        """
+        Find the first shot bullet which overlaps the rectangle
+        :param rect: rectangle of the sprite
+        :return: group of sprites which this bullet damages or None
+        """
+        self.flush()
+        if not len(self.x):
+            return None
+        if self.sides is None:
+            self.index_cells()
+        left, top, right, bottom = rect.left, rect.top, rect.right, rect.bottom
+        sides, first = self.sides, None
+        for y in range(top // SPATIAL_CELL - 1, (bottom - 1) // SPATIAL_CELL + 1):
+            for x in range(left // SPATIAL_CELL - 1, (right - 1) // SPATIAL_CELL + 1):
+                for index in self.cells.get(x + y * SPATIAL_ROW, ()):
+                    if first is None or index < first:
+                        bullet_left, bullet_top, bullet_right, bullet_bottom = sides[index]
+                        if bullet_left < right and left < bullet_right and \
+                                bullet_top < bottom and top < bullet_bottom:
+                            first = index
+        if first is None:
+            return None
+        return self.targets[self.target[first]]
+
+    def index_cells(self):
+        """
+        Put all bullets into the cells of their top left corners. Bullets are not bigger than
+        a cell, so a bullet can overlap only its cell and the next cells to the right and down
+        :return: None
+        """
+        self.sides = list(zip(self.x.tolist(), self.y.tolist(), (self.x + self.width).tolist(),
+                              (self.y + self.height).tolist()))
+        self.cells = {}
+        keys = (self.x // SPATIAL_CELL + self.y // SPATIAL_CELL * SPATIAL_ROW).tolist()
+        for index, key in enumerate(keys):
+            if key in self.cells:
+                self.cells[key].append(index)
+            else:
+                self.cells[key] = [index]
 
-    def play(self):
-        self.running = True
+    def add_to_cells(self, index, left, top, right, bottom):
+        """
+        Put the new bullet into the cell of its top left corner
+        :param index: index of the bullet
+        :param left: left side of the bullet
+        :param top: top side of the bullet
+        :param right: right side of the bullet
+        :param bottom: bottom side of the bullet
+        :return: None
+        """
+        self.sides.append((left, top, right, bottom))
+        self.cells.setdefault(left // SPATIAL_CELL + top // SPATIAL_CELL * SPATIAL_ROW,
+                              []).append(index)
 
-    def change_direction(self, direction):
-        if direction != self.direction:
-            self.image_gif = self.images[direction]
-            self.frames = []
-            self.startpoint = 0
-            self.ptime = time.time()
-            self.cur = 0
-            get_frames(self)
-            self.breakpoint = len(self.frames) - 1
-            self.render()
-            self.direction = direction
+    def render(self):
+        """
+        Change the frames of the bullets whose frame time is over
+        :return: None
+        """
+        if not len(self.x):
+            return
+        now = time.time()
+        due = now - self.ptime > self.durations[self.frame_set, self.frame]
+        if not due.any():
+            return
+        self.frame[due] = (self.frame[due] + 1) % self.lengths[self.frame_set[due]]
+        self.ptime[due] = now
+
+    def draw(self, surface):
+        """
+        Draw all bullets with one blits call
+        :param surface: surface where bullets are drawn
+        :return: list of changed areas
+        """
+        self.flush()
+        self.render()
+        frame_sets = self.frame_sets
+        return surface.blits([(frame_sets[frame_set][frame][0], (x, y)) for x, y, frame_set, frame
+                              in zip(self.x.tolist(), self.y.tolist(),
+                                     self.frame_set.tolist(), self.frame.tolist())])
 
 
 class Artifact(pygame.sprite.Sprite):
@@ -1700,7 +3589,7 @@ class Artifact(pygame.sprite.Sprite):
         super().__init__(main.artifact_group)
         self.main = main
         if not winner:
-            self.art_name = choice(list(self.main.art_parameters.keys())[:-1])
+            self.art_name = self.main.rng.choice(list(self.main.art_parameters.keys())[:-1])
         else:
             self.art_name = 'prize'
         self.pos_x = pos_x
@@ -1715,7 +3604,7 @@ class Artifact(pygame.sprite.Sprite):
         Check collision between artifact and other subjects
         :return: None
         """
-        if pygame.sprite.spritecollide(self, self.main.player_group, False):
+        if self.rect.colliderect(self.main.player.rect):
             player_parameters = self.main.player.player_parameters
             self.main.music.artifact_get()
             for i in (0, 4, 3):
@@ -1735,13 +3624,54 @@ class Artifact(pygame.sprite.Sprite):
                 self.main.game_map.update_doors()
             if self.parameters[-1] == True:
                 self.main.congratulations()
-        if pygame.sprite.spritecollide(self, self.main.bullet_group, False):
+        if self.main.bullets.first_hit(self.rect) is not None:
             print('Ouch!')
 
 
 FPS = 50
-pygame.init()
-
-app = Main()
+# update only changed areas of the screen (for computers where drawing is slow)
+# (or PUNKS_DIRTY_RECTS=1 environment variable or --dirty-rects)
+DIRTY_RENDERING = False
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Punks not ded!')
+    parser.add_argument('--headless', action='store_true',
+                        help='simulate the game without window, sound and frame limiter')
+    parser.add_argument('--frames', type=int, default=3000, help='frames to simulate (headless)')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the map generation')
+    parser.add_argument('--input', default=None, help='file with the input script')
+    parser.add_argument('--record', default=None, help='file where the keyboard input is saved')
+    parser.add_argument('--timings-csv', default=None,
+                        help='file where the timings of the frame phases are saved on exit')
+    parser.add_argument('--dirty-rects', action='store_true', default=None,
+                        help='update only changed areas of the screen')
+    args = parser.parse_args()
+    if args.headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.init()
+
+    app = Main(args.headless, args.seed, args.input, args.record, args.timings_csv,
+               args.dirty_rects)
+    if args.headless:
+        report = app.simulate(args.frames)
+        print('Frames: {frames}, time: {seconds:.3f} s, {fps:.1f} frames/s'.format(**report))
+        for phase, milliseconds in report['phases'].items():
+            print('{:<12} {:.4f} ms'.format(phase, milliseconds))
+        print('Images: {size}, hit rate {hit_rate:.1%}'.format(**image_cache.stats()))
+        print('Animations: {size}, hit rate {hit_rate:.1%}'.format(**animation_cache.stats()))
+        print('Levels: {from_pack} from pack, {from_files} from files'.format(**app.levels.stats()))
+        print('Rooms: {prefetched} prefetched, {planned} drawn on entry, '
+              '{built} built on entry'.format(**app.prefetcher.stats()))
+        print('AI: {decisions} decisions, {deferred} deferred'.format(**app.ai.stats()))
+        transitions = app.timer.windows.get('room_load')
+        if transitions:
+            print('Room transitions: {}, mean {:.3f} ms, max {:.3f} ms'.format(
+                len(transitions), sum(transitions) * 1000 / len(transitions),
+                max(transitions) * 1000))
+        if args.timings_csv:
+            app.timer.save_csv(args.timings_csv)
+    else:
+        app.run()
 
-pygame.quit()
+    pygame.quit()